@@ -0,0 +1,220 @@
+"""
+A local stand-in for the Luma Dream Machine API, for load and soak tests.
+
+Generations move from `queued` to `dreaming` to `completed` (or `failed`,
+at `--failure-rate`) over `--generation-seconds`, and their assets are
+served from the same server. Point the SDK at it with
+
+    LUMAAI_BASE_URL=http://127.0.0.1:8765 python ...
+
+Run standalone from the repository root:
+
+    python benchmarks/fake_luma_server.py --port 8765
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+# Forget generations this long after they finish, so a long soak does not
+# grow the server's own memory.
+RETENTION = 600
+
+GENERATION_PATH = re.compile(r"^/generations/([^/]+)(?:/(upscale|audio))?$")
+ASSET_PATH = re.compile(r"^/assets/([^/.]+)\.(mp4|jpg)$")
+
+
+class FakeLuma:
+    def __init__(self, generation_seconds=2.0, jitter=0.5, failure_rate=0.0, video_kb=512):
+        self.generation_seconds = generation_seconds
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.video = os.urandom(video_kb * 1024)
+        buffer = io.BytesIO()
+        Image.new("RGB", (640, 360), (40, 80, 160)).save(buffer, format="JPEG")
+        self.image = buffer.getvalue()
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def create(self, kind, request, source=None):
+        duration = self.generation_seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+        generation = {
+            "id": str(uuid.uuid4()),
+            "kind": kind,
+            "model": request.get("model") or (source or {}).get("model"),
+            "request": request,
+            "created": time.time(),
+            "duration": max(duration, 0.0),
+            "fails": random.random() < self.failure_rate,
+        }
+        with self.lock:
+            self.prune()
+            self.generations[generation["id"]] = generation
+        return generation
+
+    def get(self, generation_id):
+        with self.lock:
+            return self.generations.get(generation_id)
+
+    def delete(self, generation_id):
+        with self.lock:
+            return self.generations.pop(generation_id, None) is not None
+
+    def prune(self):
+        cutoff = time.time() - RETENTION
+        for generation_id, generation in list(self.generations.items()):
+            if generation["created"] + generation["duration"] < cutoff:
+                del self.generations[generation_id]
+
+    def state(self, generation):
+        elapsed = time.time() - generation["created"]
+        if elapsed < 0.2 * generation["duration"]:
+            return "queued"
+        if elapsed < generation["duration"]:
+            return "dreaming"
+        return "failed" if generation["fails"] else "completed"
+
+    def render(self, generation, base_url):
+        state = self.state(generation)
+        assets = None
+        if state == "completed":
+            if generation["kind"] == "image":
+                assets = {"image": f"{base_url}/assets/{generation['id']}.jpg"}
+            else:
+                assets = {"video": f"{base_url}/assets/{generation['id']}.mp4"}
+        created_at = datetime.fromtimestamp(generation["created"], timezone.utc)
+        return {
+            "id": generation["id"],
+            "generation_type": "image" if generation["kind"] == "image" else "video",
+            "state": state,
+            "failure_reason": "Internal server error" if state == "failed" else None,
+            "created_at": created_at.isoformat(),
+            "assets": assets,
+            "model": generation["model"],
+            "request": generation["request"],
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def luma(self):
+        return self.server.luma
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b"", content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def path_only(self):
+        path = self.path.split("?", 1)[0]
+        # Accept the SDK's default /dream-machine/v1 prefix as well.
+        return path[len("/dream-machine/v1"):] if path.startswith("/dream-machine/v1") else path
+
+    def do_POST(self):
+        path = self.path_only()
+        request = self.read_json()
+        if path == "/generations":
+            generation = self.luma.create("video", request)
+        elif path == "/generations/image":
+            generation = self.luma.create("image", request)
+        else:
+            match = GENERATION_PATH.match(path)
+            source = match and match.group(2) and self.luma.get(match.group(1))
+            if not source:
+                return self.send(404, {"detail": "Generation not found"})
+            generation = self.luma.create(match.group(2), request, source)
+        self.send(201, self.luma.render(generation, self.base_url))
+
+    def do_GET(self):
+        path = self.path_only()
+        match = ASSET_PATH.match(path)
+        if match:
+            if self.luma.get(match.group(1)) is None:
+                return self.send(404, {"detail": "Asset not found"})
+            if match.group(2) == "jpg":
+                return self.send(200, self.luma.image, "image/jpeg")
+            return self.send(200, self.luma.video, "video/mp4")
+
+        match = GENERATION_PATH.match(path)
+        generation = match and not match.group(2) and self.luma.get(match.group(1))
+        if not generation:
+            return self.send(404, {"detail": "Generation not found"})
+        self.send(200, self.luma.render(generation, self.base_url))
+
+    def do_DELETE(self):
+        match = GENERATION_PATH.match(self.path_only())
+        if not match or match.group(2) or not self.luma.delete(match.group(1)):
+            return self.send(404, {"detail": "Generation not found"})
+        self.send(204)
+
+
+def make_server(host="127.0.0.1", port=0, **options):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.luma = FakeLuma(**options)
+    return server
+
+
+def serve(ready=None, host="127.0.0.1", port=0, **options):
+    """
+    Serve forever; `ready` (a multiprocessing queue) receives the base URL.
+    """
+    server = make_server(host, port, **options)
+    host, port = server.server_address[:2]
+    if ready is not None:
+        ready.put(f"http://{host}:{port}")
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--generation-seconds", type=float, default=2.0)
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--video-kb", type=int, default=512)
+    args = parser.parse_args()
+
+    server = make_server(
+        args.host,
+        args.port,
+        generation_seconds=args.generation_seconds,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        video_kb=args.video_kb,
+    )
+    print(f"Fake Luma API listening on http://{args.host}:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
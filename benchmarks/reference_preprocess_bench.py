@@ -0,0 +1,103 @@
+"""
+Compare uploading reference images as full-size PNGs (what ImgBBUpload used
+to do) against the downscaled, re-encoded references it sends now.
+
+Run from the repository root:
+
+    python benchmarks/reference_preprocess_bench.py --batch 4 --height 3024 --width 4032
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "py"))
+
+from reference_preprocess import FORMATS, MAX_REFERENCE_SIZE, preprocess_references  # noqa: E402
+
+
+def synthetic_batch(batch, height, width, seed=0):
+    """
+    Photo-like test images: smooth gradients with mild noise, which compress
+    roughly like real photographs (pure noise would not compress at all).
+    """
+    generator = torch.Generator().manual_seed(seed)
+    y = torch.linspace(0, 1, height).view(1, height, 1, 1)
+    x = torch.linspace(0, 1, width).view(1, 1, width, 1)
+    phase = torch.rand(batch, 1, 1, 3, generator=generator) * 6.28
+    images = 0.5 + 0.25 * torch.sin(6 * x + phase) * torch.cos(4 * y + phase)
+    images = images + 0.03 * torch.randn(batch, height, width, 3, generator=generator)
+    return images.clamp(0, 1)
+
+
+def encode_baseline(images):
+    encoded = []
+    for image in images:
+        array = np.clip(255.0 * image.cpu().numpy(), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(array).save(buffer, format="PNG")
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def timed(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--max-size", type=int, default=MAX_REFERENCE_SIZE)
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument(
+        "--upload-mbps",
+        type=float,
+        default=20.0,
+        help="uplink bandwidth used to estimate upload time",
+    )
+    args = parser.parse_args()
+
+    images = synthetic_batch(args.batch, args.height, args.width)
+    print(
+        f"{args.batch} references of {args.width}x{args.height}, "
+        f"max_size={args.max_size}, uplink {args.upload_mbps} Mbit/s"
+    )
+    print(f"{'variant':<14}{'KB/ref':>10}{'encode ms/ref':>15}{'upload ms/ref':>15}")
+
+    rows = [("PNG original",) + timed(encode_baseline, images)]
+    for format in FORMATS:
+        rows.append(
+            (format,)
+            + timed(preprocess_references, images, args.max_size, format, args.quality)
+        )
+
+    baseline_bytes = sum(len(data) for data in rows[0][1]) / args.batch
+    baseline_total = None
+    for name, encoded, elapsed in rows:
+        size = sum(len(data) for data in encoded) / args.batch
+        encode_ms = 1000 * elapsed / args.batch
+        upload_ms = 1000 * size * 8 / (args.upload_mbps * 1e6)
+        total = encode_ms + upload_ms
+        if baseline_total is None:
+            baseline_total = total
+        print(
+            f"{name:<14}{size / 1024:>10.0f}{encode_ms:>15.1f}{upload_ms:>15.1f}"
+            f"   saves {baseline_bytes - size:>9.0f} B, {baseline_total - total:>7.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+"""
+Soak test: drive the generation nodes for a long time against a local fake
+Luma API (benchmarks/fake_luma_server.py) and watch for leaks.
+
+Jobs arrive at `--rate` per second (Poisson) and run on `--concurrency`
+workers, like a busy ComfyUI queue. Every `--sample-interval` seconds the
+process's RSS, open file descriptors and thread count are recorded with
+latency percentiles and error rates; `--output` writes the samples as JSON
+lines. The run fails (exit status 1) if resources keep growing after the
+warmup or too many jobs fail.
+
+The nodes import ComfyUI modules, so this needs a ComfyUI checkout. Run it
+from the repository root with ComfyUI's Python environment:
+
+    python benchmarks/soak_test.py --comfyui ../.. --duration 3600 --rate 2
+    python benchmarks/soak_test.py --comfyui ../.. --async --concurrency 64
+"""
+import argparse
+import asyncio
+import importlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_luma_server import serve
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "comfyui_lumaai_soak"
+RESERVOIR_SIZE = 10000
+
+
+def load_nodes(comfyui_path):
+    """
+    Import the extension the way ComfyUI does: as a package loaded from the
+    repository directory, with ComfyUI's own modules importable.
+    """
+    sys.path.insert(0, os.path.abspath(comfyui_path))
+    spec = importlib.util.spec_from_file_location(
+        PACKAGE,
+        os.path.join(REPO_DIR, "__init__.py"),
+        submodule_search_locations=[REPO_DIR],
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE] = package
+    spec.loader.exec_module(package)
+    return (
+        importlib.import_module(f"{PACKAGE}.py.lumaai_api_node"),
+        importlib.import_module(f"{PACKAGE}.py.async_nodes"),
+    )
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        pass
+    try:
+        import psutil
+
+        process = psutil.Process()
+        return process.num_fds() if hasattr(process, "num_fds") else process.num_handles()
+    except ImportError:
+        return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Metrics:
+    """
+    Job outcomes and latencies. Memory stays bounded however long the run:
+    recent latencies are kept for `window` seconds, and the whole-run
+    percentiles come from a fixed-size random sample.
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self.started = time.time()
+        self.submitted = 0
+        self.completed = 0
+        self.errors = Counter()
+        self.recent = deque()
+        self.reservoir = []
+        self.lock = threading.Lock()
+
+    def submit(self):
+        with self.lock:
+            self.submitted += 1
+
+    def finish(self, kind, latency, error=None):
+        now = time.time()
+        with self.lock:
+            if error is not None:
+                self.errors[f"{kind}: {type(error).__name__}"] += 1
+                self.recent.append((now, None))
+                return
+            self.completed += 1
+            self.recent.append((now, latency))
+            if len(self.reservoir) < RESERVOIR_SIZE:
+                self.reservoir.append(latency)
+            else:
+                index = random.randrange(self.completed)
+                if index < RESERVOIR_SIZE:
+                    self.reservoir[index] = latency
+
+    def sample(self):
+        now = time.time()
+        with self.lock:
+            while self.recent and self.recent[0][0] < now - self.window:
+                self.recent.popleft()
+            latencies = [latency for _, latency in self.recent if latency is not None]
+            failed = len(self.recent) - len(latencies)
+            errors = sum(self.errors.values())
+            return {
+                "time": round(now - self.started, 1),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "errors": errors,
+                "in_flight": self.submitted - self.completed - errors,
+                "throughput": round(len(latencies) / self.window, 3),
+                "error_rate": round(failed / len(self.recent), 4) if self.recent else 0.0,
+                "p50": percentile(latencies, 0.5),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+            }
+
+
+class Workload:
+    """
+    Builds node calls for a job mix such as "text2video:3,image:1,upscale:1".
+    Upscales use a recently completed video, or fall back to text2video.
+    """
+
+    def __init__(self, mix, module, async_module, output_dir):
+        self.kinds, self.weights = [], []
+        for item in mix.split(","):
+            kind, _, weight = item.partition(":")
+            if kind.strip() not in ("text2video", "image", "upscale"):
+                raise ValueError(f"Unknown job kind: {kind}")
+            self.kinds.append(kind.strip())
+            self.weights.append(float(weight or 1))
+        self.module = module
+        self.async_module = async_module
+        self.output_dir = output_dir
+        self.videos = deque(maxlen=100)
+        self.count = 0
+
+    def choose(self):
+        kind = random.choices(self.kinds, self.weights)[0]
+        if kind == "upscale" and not self.videos:
+            kind = "text2video"
+        self.count += 1
+        return kind, self.count
+
+    def inputs(self, kind, number):
+        # Distinct prompts, so a coordination backend never deduplicates jobs.
+        if kind == "text2video":
+            return dict(
+                model="ray-flash-2",
+                prompt=f"soak test {number}",
+                duration="5s",
+                loop=False,
+                aspect_ratio="16:9",
+                resolution="540p",
+            )
+        if kind == "image":
+            return dict(model="photon-flash-1", prompt=f"soak test {number}", aspect_ratio="16:9")
+        return dict(generation_id=random.choice(self.videos), resolution="1080p")
+
+    def node(self, kind, use_async):
+        names = {"text2video": "Text2Video", "image": "ImageGeneration", "upscale": "UpscaleGeneration"}
+        if use_async:
+            return getattr(self.async_module, "Async" + names[kind])()
+        return getattr(self.module, names[kind])()
+
+    def run(self, client, kind, number):
+        node, inputs = self.node(kind, False), self.inputs(kind, number)
+        if kind == "image":
+            result = node.run(client, **inputs)
+        else:
+            result = node.run(client, save=True, filename="", **inputs)
+        self.finish(kind, result)
+
+    async def async_run(self, client, kind, number):
+        node, inputs = self.node(kind, True), self.inputs(kind, number)
+        if kind == "image":
+            result = await node.run(client, **inputs)
+        else:
+            result = await node.run(client, save=True, **inputs)
+        self.finish(kind, result)
+
+    def finish(self, kind, result):
+        generation_id = result["result"][1]
+        extension = ".jpg" if kind == "image" else ".mp4"
+        path, _ = self.module.asset_path(generation_id, "", extension, self.output_dir)
+        os.remove(path)
+        if kind == "text2video":
+            self.videos.append(generation_id)
+
+
+class Dispatcher:
+    """
+    Runs jobs on a thread pool, or on one event loop with the async nodes.
+    """
+
+    def __init__(self, workload, metrics, client, concurrency, use_async):
+        self.workload = workload
+        self.metrics = metrics
+        self.client = client
+        self.use_async = use_async
+        if use_async:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+            self.semaphore = asyncio.run_coroutine_threadsafe(
+                self.make_semaphore(concurrency), self.loop
+            ).result()
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def make_semaphore(self, concurrency):
+        return asyncio.Semaphore(concurrency)
+
+    def submit(self):
+        kind, number = self.workload.choose()
+        self.metrics.submit()
+        # Latency is measured from arrival, so it includes time spent queued.
+        queued = time.time()
+        if self.use_async:
+            asyncio.run_coroutine_threadsafe(self.async_job(kind, number, queued), self.loop)
+        else:
+            self.executor.submit(self.job, kind, number, queued)
+
+    def job(self, kind, number, queued):
+        try:
+            self.workload.run(self.client, kind, number)
+        except Exception as e:
+            self.metrics.finish(kind, time.time() - queued, e)
+        else:
+            self.metrics.finish(kind, time.time() - queued)
+
+    async def async_job(self, kind, number, queued):
+        async with self.semaphore:
+            try:
+                await self.workload.async_run(self.client, kind, number)
+            except Exception as e:
+                self.metrics.finish(kind, time.time() - queued, e)
+            else:
+                self.metrics.finish(kind, time.time() - queued)
+
+    def shutdown(self, timeout):
+        if self.use_async:
+            deadline = time.time() + timeout
+            while self.metrics.sample()["in_flight"] > 0 and time.time() < deadline:
+                time.sleep(0.5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        else:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def growth(samples, key):
+    """
+    Median of the last third of `samples` minus the median of the first
+    third, which ignores short spikes but catches steady growth.
+    """
+    values = [sample[key] for sample in samples if sample.get(key) is not None]
+    if len(values) < 3:
+        return None
+    third = len(values) // 3
+    return statistics.median(values[-third:]) - statistics.median(values[:third])
+
+
+def verdict(samples, metrics, args):
+    failures = []
+    steady = [sample for sample in samples if sample["time"] >= args.warmup]
+    if len(steady) < 6:
+        failures.append(
+            f"only {len(steady)} samples after the warmup; run for longer or sample more often"
+        )
+    limits = [
+        ("rss_mb", args.max_rss_growth, "MB"),
+        ("open_fds", args.max_fd_growth, " file descriptors"),
+        ("threads", args.max_thread_growth, " threads"),
+    ]
+    for key, limit, unit in limits:
+        grown = growth(steady, key)
+        if grown is not None and grown > limit:
+            failures.append(f"{key} grew by {grown:g}{unit} (limit {limit:g})")
+
+    final = metrics.sample()
+    attempted = final["completed"] + final["errors"]
+    error_rate = final["errors"] / attempted if attempted else 0.0
+    if error_rate > args.max_error_rate:
+        failures.append(f"error rate {error_rate:.2%} (limit {args.max_error_rate:.2%})")
+    if attempted == 0:
+        failures.append("no jobs finished")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--comfyui",
+        default=os.environ.get("COMFYUI_PATH", os.path.join(REPO_DIR, "..", "..")),
+        help="ComfyUI checkout (default: two levels up, as in custom_nodes)",
+    )
+    parser.add_argument("--duration", type=float, default=600, help="seconds")
+    parser.add_argument("--warmup", type=float, default=60, help="seconds ignored by the growth checks")
+    parser.add_argument("--rate", type=float, default=2.0, help="jobs per second")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the async nodes")
+    parser.add_argument("--mix", default="text2video:3,image:1,upscale:1")
+    parser.add_argument("--sample-interval", type=float, default=10)
+    parser.add_argument("--window", type=float, default=60, help="seconds of latencies per sample")
+    parser.add_argument("--output", help="write samples to this file as JSON lines")
+    parser.add_argument("--generation-seconds", type=float, default=2.0)
+    parser.add_argument("--failure-rate", type=float, default=0.02, help="generations the fake API fails")
+    parser.add_argument("--video-kb", type=int, default=512)
+    parser.add_argument("--max-rss-growth", type=float, default=50, help="MB")
+    parser.add_argument("--max-fd-growth", type=float, default=10)
+    parser.add_argument("--max-thread-growth", type=float, default=5)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    # The fake API runs in its own process so its memory, sockets and
+    # threads are not counted against the nodes.
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    server = context.Process(
+        target=serve,
+        args=(ready,),
+        kwargs=dict(
+            generation_seconds=args.generation_seconds,
+            failure_rate=args.failure_rate,
+            video_kb=args.video_kb,
+        ),
+        daemon=True,
+    )
+    server.start()
+    os.environ["LUMAAI_BASE_URL"] = ready.get(timeout=30)
+
+    module, async_module = load_nodes(args.comfyui)
+    import folder_paths
+
+    output_dir = tempfile.mkdtemp(prefix="luma_soak_")
+    folder_paths.set_output_directory(output_dir)
+    # Keep fake spend out of the real ledger; both modules hold a reference.
+    module.accountant = async_module.accountant = module.Accountant(
+        os.path.join(output_dir, "spend.sqlite"), pending_jobs=module.queued_prompts
+    )
+    client = module.LumaAIClient().run("soak-test")[0]
+
+    metrics = Metrics(args.window)
+    workload = Workload(args.mix, module, async_module, output_dir)
+    dispatcher = Dispatcher(workload, metrics, client, args.concurrency, args.use_async)
+    output = open(args.output, "w") if args.output else None
+
+    print(
+        f"Soak test against {os.environ['LUMAAI_BASE_URL']}: {args.rate} jobs/s, "
+        f"concurrency {args.concurrency}, {'async' if args.use_async else 'threaded'} nodes, "
+        f"{args.duration:g}s"
+    )
+    samples = []
+    started = time.time()
+    next_sample = started + args.sample_interval
+    next_arrival = started
+    try:
+        while time.time() < started + args.duration:
+            now = time.time()
+            if now >= next_arrival:
+                dispatcher.submit()
+                next_arrival += random.expovariate(args.rate)
+            if now >= next_sample:
+                rss = rss_bytes()
+                sample = dict(
+                    metrics.sample(),
+                    rss_mb=round(rss / 2**20, 1) if rss is not None else None,
+                    open_fds=open_fds(),
+                    threads=threading.active_count(),
+                    cache=module.generation_cache.stats(),
+                )
+                samples.append(sample)
+                print(
+                    f"[{sample['time']:>7.0f}s] done {sample['completed']:>6} "
+                    f"errors {sample['errors']:>4} in flight {sample['in_flight']:>4} "
+                    f"p50/p95/p99 {sample['p50'] or 0:.1f}/{sample['p95'] or 0:.1f}/"
+                    f"{sample['p99'] or 0:.1f}s rss {sample['rss_mb']}MB "
+                    f"fds {sample['open_fds']} threads {sample['threads']}"
+                )
+                if output is not None:
+                    output.write(json.dumps(sample) + "\n")
+                    output.flush()
+                next_sample += args.sample_interval
+            time.sleep(max(0.0, min(next_arrival, next_sample) - time.time()))
+    except KeyboardInterrupt:
+        print("Interrupted, finishing up")
+    finally:
+        dispatcher.shutdown(timeout=args.generation_seconds * 10 + 30)
+        server.terminate()
+        if output is not None:
+            output.close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    reservoir = metrics.reservoir
+    print(
+        f"Latency over the whole run: p50 {percentile(reservoir, 0.5) or 0:.2f}s, "
+        f"p95 {percentile(reservoir, 0.95) or 0:.2f}s, p99 {percentile(reservoir, 0.99) or 0:.2f}s"
+    )
+    for error, count in metrics.errors.most_common():
+        print(f"  {count} x {error}")
+    print(f"Retries: {module.retry_policy.stats.snapshot()}")
+
+    failures = verdict(samples, metrics, args)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("PASS")
+
+
+if __name__ == "__main__":
+    main()
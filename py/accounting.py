@@ -0,0 +1,278 @@
+import asyncio
+import contextlib
+import sqlite3
+import threading
+import time
+
+# Estimated USD per million output pixels, from the published API pricing
+# (https://lumalabs.ai/dream-machine/api/pricing). Override with PRICES in
+# the [Budget] section of config.ini when prices change.
+PRICE_PER_MEGAPIXEL = {
+    "ray-2": 0.0064,
+    "ray-flash-2": 0.0022,
+    "ray-1.6": 0.0045,
+    "photon-1": 0.0073,
+    "photon-flash-1": 0.0019,
+    "upscale": 0.0016,
+}
+AUDIO_PRICE_PER_SECOND = 0.02
+
+FPS = 24
+RESOLUTIONS = ["540p", "720p", "1080p", "4k"]
+RESOLUTION_PIXELS = {
+    "540p": 960 * 540,
+    "720p": 1280 * 720,
+    "1080p": 1920 * 1080,
+    "4k": 3840 * 2160,
+}
+IMAGE_PIXELS = 1920 * 1080
+DEFAULT_SECONDS = 5
+FLASH_MODELS = {"ray-2": "ray-flash-2", "photon-1": "photon-flash-1"}
+
+
+class BudgetExceeded(ValueError):
+    pass
+
+
+def parse_prices(value):
+    """
+    Parse "model: price, model: price" overrides from config.ini.
+    """
+    prices = {}
+    for item in value.split(","):
+        if ":" in item:
+            model, price = item.split(":", 1)
+            prices[model.strip()] = float(price)
+    return prices
+
+
+class Accountant:
+    """
+    Estimates what a request will cost, keeps a ledger of spend per
+    generation and enforces daily and per-workflow budgets before anything
+    is submitted, optionally downgrading requests to fit.
+    """
+
+    def __init__(
+        self,
+        ledger_path,
+        daily_budget=0,
+        workflow_budget=0,
+        auto_downgrade=False,
+        prices=None,
+        pending_jobs=None,
+    ):
+        self.ledger_path = ledger_path
+        self.daily_budget = daily_budget
+        self.workflow_budget = workflow_budget
+        self.auto_downgrade = auto_downgrade
+        self.prices = dict(PRICE_PER_MEGAPIXEL, **(prices or {}))
+        self.pending_jobs = pending_jobs or (lambda: 1)
+        self._reserved = {}
+        self._lock = threading.Lock()
+        # Serializes the budget check with the reservation, so concurrent
+        # requests cannot all spend the same remaining budget.
+        self._charge_lock = threading.Lock()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS spend (generation_id TEXT PRIMARY KEY, "
+                    "workflow TEXT, time REAL, kind TEXT, model TEXT, seconds REAL, cost REAL)"
+                )
+        except sqlite3.Error as e:
+            print(f"Warning: cannot open spend ledger {ledger_path}: {e}")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.ledger_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def seconds(self, kind, request):
+        if kind in ("upscale", "audio"):
+            # These keep the length of their source generation.
+            try:
+                with self._connect() as conn:
+                    row = conn.execute(
+                        "SELECT seconds FROM spend WHERE generation_id = ?", (request["id"],)
+                    ).fetchone()
+            except sqlite3.Error:
+                row = None
+            return row[0] if row else DEFAULT_SECONDS
+        duration = request.get("duration") or f"{DEFAULT_SECONDS}s"
+        return float(str(duration).rstrip("s"))
+
+    def estimate(self, kind, request):
+        """
+        Estimated cost in USD of a request as passed to run_generation.
+        """
+        if kind == "image":
+            return self.prices.get(request.get("model"), 0) * IMAGE_PIXELS / 1e6
+        if kind == "audio":
+            return AUDIO_PRICE_PER_SECOND * self.seconds(kind, request)
+        pixels = RESOLUTION_PIXELS.get(request.get("resolution"), RESOLUTION_PIXELS["720p"])
+        frames = FPS * self.seconds(kind, request)
+        rate = self.prices["upscale"] if kind == "upscale" else self.prices.get(request.get("model"), 0)
+        return rate * pixels * frames / 1e6
+
+    def spent(self, since=None, workflow=None):
+        query, params = "SELECT COALESCE(SUM(cost), 0) FROM spend WHERE 1 = 1", []
+        if since is not None:
+            query += " AND time >= ?"
+            params.append(since)
+        if workflow is not None:
+            query += " AND workflow = ?"
+            params.append(workflow)
+        with self._connect() as conn:
+            return conn.execute(query, params).fetchone()[0]
+
+    def remaining(self, workflow=None):
+        """
+        Budget left after spend and in-flight reservations, or None if no
+        budget applies.
+        """
+        limits = []
+        with self._lock:
+            reserved = list(self._reserved.values())
+        if self.daily_budget:
+            midnight = time.mktime(time.localtime()[:3] + (0, 0, 0, 0, 0, -1))
+            in_flight = sum(cost for _, cost in reserved)
+            limits.append(self.daily_budget - self.spent(since=midnight) - in_flight)
+        if self.workflow_budget and workflow is not None:
+            in_flight = sum(cost for owner, cost in reserved if owner == workflow)
+            limits.append(
+                self.workflow_budget - self.spent(workflow=workflow) - in_flight
+            )
+        return min(limits) if limits else None
+
+    def cheaper_variants(self, kind, request):
+        """
+        Lower resolutions and flash models for a request, most expensive first.
+        """
+        if kind == "upscale":
+            # A lower target resolution would not upscale the source at all.
+            return []
+        models = [request.get("model")]
+        if request.get("model") in FLASH_MODELS:
+            models.append(FLASH_MODELS[request["model"]])
+        resolutions = [request.get("resolution")]
+        if request.get("resolution") in RESOLUTIONS:
+            resolutions = RESOLUTIONS[: RESOLUTIONS.index(request["resolution"]) + 1]
+
+        variants = []
+        for model in models:
+            for resolution in resolutions:
+                variant = dict(request)
+                if model is not None:
+                    variant["model"] = model
+                if resolution is not None:
+                    variant["resolution"] = resolution
+                if variant != request:
+                    variants.append(variant)
+        return sorted(variants, key=lambda v: self.estimate(kind, v), reverse=True)
+
+    def fit(self, kind, request, workflow=None):
+        """
+        Return `request`, or a cheaper variant of it, that fits the budget.
+        With several prompts queued, each gets an equal share of what is left,
+        so the budget completes as many of them as possible.
+        """
+        remaining = self.remaining(workflow)
+        cost = self.estimate(kind, request)
+        if remaining is None or (cost <= remaining and not self.auto_downgrade):
+            return request
+
+        allowance = remaining / max(1, self.pending_jobs())
+        if cost <= allowance:
+            return request
+        variants = self.cheaper_variants(kind, request) if self.auto_downgrade else []
+        variant = self.first_within(kind, variants, allowance)
+        if variant is None and cost <= remaining:
+            return request
+        if variant is None:
+            variant = self.first_within(kind, variants, remaining)
+        if variant is not None:
+            print(
+                f"Budget: downgraded {kind} request to "
+                f"{variant.get('model', kind)} {variant.get('resolution', '')} "
+                f"(${self.estimate(kind, variant):.2f} instead of ${cost:.2f})"
+            )
+            return variant
+        raise BudgetExceeded(
+            f"Budget exceeded: this {kind} request costs about ${cost:.2f}, "
+            f"${max(remaining, 0):.2f} left"
+        )
+
+    def first_within(self, kind, variants, limit):
+        for variant in variants:
+            if self.estimate(kind, variant) <= limit:
+                return variant
+        return None
+
+    def reserve(self, kind, request, workflow=None):
+        """
+        Fit `request` to the budget and reserve its estimated cost in one
+        step. Returns a token for release() and the request to submit.
+        """
+        with self._charge_lock:
+            request = self.fit(kind, request, workflow)
+            estimate = self.estimate(kind, request)
+            token = object()
+            with self._lock:
+                self._reserved[token] = (workflow, estimate)
+        return token, request
+
+    def release(self, token):
+        with self._lock:
+            del self._reserved[token]
+
+    @contextlib.contextmanager
+    def charge(self, kind, request, workflow=None):
+        """
+        Check the budget and reserve the estimated cost while the request
+        runs; yields the request to submit, which may have been downgraded.
+        """
+        token, request = self.reserve(kind, request, workflow)
+        try:
+            yield request
+        finally:
+            self.release(token)
+
+    @contextlib.asynccontextmanager
+    async def async_charge(self, kind, request, workflow=None):
+        """
+        Async counterpart of charge; the ledger is read in a thread.
+        """
+        token, request = await asyncio.to_thread(self.reserve, kind, request, workflow)
+        try:
+            yield request
+        finally:
+            self.release(token)
+
+    def record(self, generation_id, kind, request, workflow=None):
+        """
+        Add a finished generation to the ledger. The generation has already
+        been paid for, so a ledger error is only logged.
+        """
+        cost = self.estimate(kind, request)
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO spend VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        generation_id,
+                        workflow,
+                        time.time(),
+                        kind,
+                        request.get("model", kind),
+                        self.seconds(kind, request),
+                        cost,
+                    ),
+                )
+        except sqlite3.Error as e:
+            print(f"Warning: could not record generation {generation_id} in the spend ledger: {e}")
+        print(f"Generation {generation_id} cost about ${cost:.2f}")
+        return cost
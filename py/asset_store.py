@@ -0,0 +1,216 @@
+import asyncio
+import contextlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from .progress import async_download_file, download_file
+
+
+class AssetStore:
+    """
+    Content-addressed store for downloaded media. Each distinct file is kept
+    once as a blob under a sharded directory and hardlinked to wherever it
+    was saved. An SQLite index maps generation IDs to blobs, and unpinned
+    blobs are evicted least-recently-used first once over `budget` bytes.
+    """
+
+    def __init__(self, root, budget=0):
+        self.root = root
+        self.budget = budget
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY, path TEXT, size INTEGER, last_access REAL
+                );
+                CREATE TABLE IF NOT EXISTS assets (
+                    generation_id TEXT PRIMARY KEY, hash TEXT
+                );
+                CREATE TABLE IF NOT EXISTS links (
+                    path TEXT PRIMARY KEY, hash TEXT, pinned INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access);
+                CREATE INDEX IF NOT EXISTS links_hash ON links (hash);
+                """
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(os.path.join(self.root, "index.sqlite"), timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def shard(name):
+        return os.path.join(name[:2], name[2:4])
+
+    def default_path(self, output_dir, generation_id, extension):
+        """
+        Sharded location for outputs saved without an explicit filename, so
+        no single directory grows without bound.
+        """
+        return os.path.join(
+            output_dir, "luma", self.shard(generation_id), generation_id + extension
+        )
+
+    def lookup(self, generation_id):
+        """
+        Path of the blob already downloaded for `generation_id`, or None.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT blobs.hash, blobs.path FROM assets JOIN blobs USING (hash) "
+                "WHERE assets.generation_id = ?",
+                (generation_id,),
+            ).fetchone()
+            if row is None or not os.path.exists(row[1]):
+                return None
+            conn.execute(
+                "UPDATE blobs SET last_access = ? WHERE hash = ?", (time.time(), row[0])
+            )
+        return row[1]
+
+    def fetch(self, generation_id, url, path, pinned=False, progress=None):
+        """
+        Make the asset for `generation_id` available at `path`, downloading it
+        only if no blob for it (or for identical content) exists yet.
+        """
+        blob_path = self.lookup(generation_id)
+        if blob_path is None:
+            tmp_path = self.temp_path()
+            blob_hash, size = download_file(url, tmp_path, progress)
+            blob_path = self.add_blob(
+                generation_id, tmp_path, blob_hash, size, os.path.splitext(path)[1]
+            )
+        else:
+            print(f"Reusing downloaded asset for {generation_id}")
+        return self.link(generation_id, blob_path, path, pinned)
+
+    async def async_fetch(self, generation_id, url, path, pinned=False, progress=None):
+        """
+        Async counterpart of fetch. The index is SQLite and linking may evict
+        files, so those steps run in a thread rather than on the event loop.
+        """
+        blob_path = await asyncio.to_thread(self.lookup, generation_id)
+        if blob_path is None:
+            tmp_path = self.temp_path()
+            blob_hash, size = await async_download_file(url, tmp_path, progress)
+            blob_path = await asyncio.to_thread(
+                self.add_blob, generation_id, tmp_path, blob_hash, size, os.path.splitext(path)[1]
+            )
+        else:
+            print(f"Reusing downloaded asset for {generation_id}")
+        return await asyncio.to_thread(self.link, generation_id, blob_path, path, pinned)
+
+    def temp_path(self):
+        return os.path.join(self.root, "tmp", uuid.uuid4().hex)
+
+    def add_blob(self, generation_id, tmp_path, blob_hash, size, extension):
+        """
+        Move a finished download into the store (or drop it if identical
+        content is already stored) and index it under `generation_id`.
+        """
+        blob_path = os.path.join(
+            self.root, "blobs", self.shard(blob_hash), blob_hash + extension
+        )
+        with self._lock, self._connect() as conn:
+            if os.path.exists(blob_path):
+                # Identical content is already stored under another generation.
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+            conn.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                (blob_hash, blob_path, size, time.time()),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO assets VALUES (?, ?)", (generation_id, blob_hash)
+            )
+        return blob_path
+
+    def link(self, generation_id, blob_path, path, pinned=False):
+        """
+        Hardlink a stored blob to `path`, record it, and evict if needed.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.abspath(path) != os.path.abspath(blob_path):
+            self._link(blob_path, path)
+        with self._connect() as conn:
+            blob_hash = conn.execute(
+                "SELECT hash FROM assets WHERE generation_id = ?", (generation_id,)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT OR REPLACE INTO links VALUES (?, ?, ?)",
+                (os.path.abspath(path), blob_hash, int(pinned)),
+            )
+        # The caller is about to use this file, so it is never evicted here.
+        self.evict(keep=blob_hash)
+        print(f"File saved as {path}")
+        return path
+
+    def _link(self, blob_path, path):
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError:
+            # Filesystems without hardlinks get a plain copy instead.
+            shutil.copyfile(blob_path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def usage(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used unpinned blobs, with every file linked to
+        them, until the store fits in its budget. The blob with hash `keep`
+        is spared.
+        """
+        if not self.budget:
+            return
+        with self._lock, self._connect() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.budget:
+                return
+            # Links deleted by hand no longer pin anything.
+            for (path,) in conn.execute("SELECT path FROM links").fetchall():
+                if not os.path.exists(path):
+                    conn.execute("DELETE FROM links WHERE path = ?", (path,))
+
+            candidates = conn.execute(
+                "SELECT hash, path, size FROM blobs WHERE hash NOT IN "
+                "(SELECT hash FROM links WHERE pinned = 1) AND hash != ? "
+                "ORDER BY last_access",
+                (keep or "",),
+            ).fetchall()
+            for blob_hash, blob_path, size in candidates:
+                if total <= self.budget:
+                    break
+                links = conn.execute(
+                    "SELECT path FROM links WHERE hash = ?", (blob_hash,)
+                ).fetchall()
+                for (path,) in links + [(blob_path,)]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                conn.execute("DELETE FROM links WHERE hash = ?", (blob_hash,))
+                conn.execute("DELETE FROM assets WHERE hash = ?", (blob_hash,))
+                conn.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+                total -= size
+                print(f"Evicted asset {blob_hash} ({size} bytes)")
+
+            if total > self.budget:
+                print(
+                    f"Warning: pinned and in-use assets use {total} bytes, over the "
+                    f"{self.budget} byte budget"
+                )
@@ -0,0 +1,258 @@
+import asyncio
+import time
+import weakref
+
+import nodes
+from comfy.model_management import InterruptProcessingException
+from lumaai import AsyncLumaAI
+
+from .generation_cache import check_source, source_generation_ids
+from .generation_policy import GenerationFailed, GenerationStalled, duration_key
+from .lumaai_api_node import (
+    AddAudio2Video,
+    ExtendGeneration,
+    ImageGeneration,
+    Image2Video,
+    InterpolateGenerations,
+    ModifyImage,
+    Text2Video,
+    UpscaleGeneration,
+    accountant,
+    asset_path,
+    asset_store,
+    coordinator,
+    create_generation,
+    delete_on_cancel,
+    generation_cache,
+    retry_policy,
+)
+from .progress import (
+    GenerationProgress,
+    async_download_file,
+    current_prompt_id,
+    interruptible_async_sleep,
+)
+
+# Async clients hold connection pools bound to the event loop that created
+# them, so they are cached per loop and dropped along with it.
+async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client(client):
+    """
+    Async client sharing the credentials of a LUMACLIENT.
+    """
+    clients = async_clients.setdefault(asyncio.get_running_loop(), {})
+    if client.auth_token not in clients:
+        clients[client.auth_token] = AsyncLumaAI(auth_token=client.auth_token)
+    return clients[client.auth_token]
+
+
+async def wait_for_generation(
+    client, generation_id, interval=3, stall_timeout=None, progress=None, expected=None
+):
+    started = time.time()
+    try:
+        while True:
+            generation = await generation_cache.async_get(client, generation_id)
+            elapsed = time.time() - started
+            if progress is not None:
+                progress.generation(generation_id, generation.state, elapsed, expected)
+            if generation.state == "completed":
+                return generation
+            if generation.state == "failed":
+                raise GenerationFailed(generation_id, generation.failure_reason)
+            if stall_timeout is not None and elapsed > stall_timeout:
+                raise GenerationStalled(generation_id, generation.state, elapsed)
+            await interruptible_async_sleep(interval)
+    except (InterruptProcessingException, asyncio.CancelledError):
+        if delete_on_cancel:
+            try:
+                await client.generations.delete(id=generation_id)
+                generation_cache.invalidate(generation_id)
+                print(f"Deleted cancelled generation {generation_id}")
+            except Exception as e:
+                print(f"Could not delete cancelled generation {generation_id}: {e}")
+        raise
+
+
+async def run_generation(client, kind, request, interval=3, policy=None, progress=None):
+    """
+    Async counterpart of lumaai_api_node.run_generation; `client` is an
+    AsyncLumaAI client.
+    """
+    for source_id in source_generation_ids(kind, request):
+        check_source(await generation_cache.async_get(client, source_id))
+
+    if coordinator is None:
+        return await submit_within_budget(client, kind, request, interval, policy, progress)
+
+    key = coordinator.request_key(kind, request)
+    generation_id = await coordinator.async_claim(key)
+    if generation_id is not None:
+        print(f"Reusing generation {generation_id} from an identical request")
+        return await generation_cache.async_get(client, generation_id)
+
+    try:
+        async with coordinator.async_slot():
+            generation = await submit_within_budget(
+                client, kind, request, interval, policy, progress
+            )
+    except BaseException:
+        await asyncio.to_thread(coordinator.abandon, key)
+        raise
+    await asyncio.to_thread(coordinator.complete, key, generation.id)
+    return generation
+
+
+async def submit_within_budget(
+    client, kind, request, interval=3, policy=None, progress=None
+):
+    workflow = current_prompt_id()
+    async with accountant.async_charge(kind, request, workflow) as request:
+        generation = await submit_with_retries(
+            client, kind, request, interval, policy, progress
+        )
+        if kind == "video" and getattr(generation, "model", None):
+            request = dict(request, model=generation.model)
+        await asyncio.to_thread(accountant.record, generation.id, kind, request, workflow)
+    return generation
+
+
+async def submit_with_retries(client, kind, request, interval=3, policy=None, progress=None):
+    policy = policy or retry_policy
+    request = dict(request)
+    started = time.time()
+    attempt = 0
+    while True:
+        if kind == "video":
+            request["model"] = policy.choose_model(request, started, attempt)
+        model = request.get("model", kind)
+        key = duration_key(kind, request)
+
+        generation = await create_generation(client, kind, request)
+        policy.stats.record(model, "submitted", generation.id)
+        submitted = time.time()
+        try:
+            generation = await wait_for_generation(
+                client,
+                generation.id,
+                interval,
+                policy.durations.stall_timeout(key),
+                progress,
+                policy.durations.expected(key),
+            )
+        except GenerationFailed as e:
+            if isinstance(e, GenerationStalled):
+                try:
+                    await client.generations.delete(id=e.generation_id)
+                    generation_cache.invalidate(e.generation_id)
+                except Exception:
+                    pass
+            if not policy.should_retry(e, attempt):
+                outcome = "stalled" if isinstance(e, GenerationStalled) else "failed"
+                policy.stats.record(model, outcome, e.generation_id, e.failure_reason)
+                raise
+            attempt += 1
+            policy.stats.record(model, "retried", e.generation_id, e.failure_reason)
+            print(
+                f"Retrying generation {e.generation_id} ({e.failure_reason}), "
+                f"attempt {attempt}/{policy.max_retries}"
+            )
+            continue
+
+        policy.durations.record(key, time.time() - submitted)
+        policy.stats.record(model, "completed", generation.id)
+        return generation
+
+
+async def save_asset(generation_id, url, filename, extension, output_dir, progress=None):
+    path, pinned = asset_path(generation_id, filename, extension, output_dir)
+    if asset_store is not None:
+        return await asset_store.async_fetch(generation_id, url, path, pinned, progress)
+    await async_download_file(url, path, progress)
+    print(f"File downloaded as {path}")
+    return path
+
+
+class AsyncVideoNode:
+    """
+    Runs a video node's request on the event loop instead of blocking an
+    executor thread. Mixed into the synchronous node classes, whose inputs
+    and request validation it reuses.
+    """
+
+    async def run(self, client, save, filename="", **inputs):
+        kind, request = self.build_request(**inputs)
+        progress = GenerationProgress()
+        generation = await run_generation(
+            get_async_client(client), kind, request, progress=progress
+        )
+        video_url = generation.assets.video
+        if save:
+            await save_asset(
+                generation.id, video_url, filename, ".mp4", self.output_dir, progress
+            )
+
+        return {
+            "ui": {"text": [generation.id]},
+            "result": (
+                video_url,
+                generation.id,
+            ),
+        }
+
+
+class AsyncImageNode:
+    async def run(self, client, filename="", **inputs):
+        kind, request = self.build_request(**inputs)
+        progress = GenerationProgress()
+        generation = await run_generation(
+            get_async_client(client),
+            kind,
+            request,
+            interval=self.POLL_INTERVAL,
+            progress=progress,
+        )
+        image_url = generation.assets.image
+        path = await save_asset(
+            generation.id, image_url, filename, ".jpg", self.output_dir, progress
+        )
+        image, _ = await asyncio.to_thread(nodes.LoadImage().load_image, path)
+
+        return {
+            "ui": {"text": [generation.id]},
+            "result": (image_url, generation.id, image),
+        }
+
+
+class AsyncText2Video(AsyncVideoNode, Text2Video):
+    pass
+
+
+class AsyncImage2Video(AsyncVideoNode, Image2Video):
+    pass
+
+
+class AsyncInterpolateGenerations(AsyncVideoNode, InterpolateGenerations):
+    pass
+
+
+class AsyncExtendGeneration(AsyncVideoNode, ExtendGeneration):
+    pass
+
+
+class AsyncUpscaleGeneration(AsyncVideoNode, UpscaleGeneration):
+    pass
+
+
+class AsyncAddAudio2Video(AsyncVideoNode, AddAudio2Video):
+    pass
+
+
+class AsyncImageGeneration(AsyncImageNode, ImageGeneration):
+    pass
+
+
+class AsyncModifyImage(AsyncImageNode, ModifyImage):
+    pass
@@ -0,0 +1,414 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import math
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+KEY_PREFIX = "lumaai:"
+
+
+class LocalBackend:
+    """
+    In-process backend; only coordinates threads of a single ComfyUI.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, time.time())
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        """
+        Set `key` only if it is absent; returns whether it was set.
+        """
+        with self._lock:
+            now = time.time()
+            if self._live(key, now) is not None:
+                return False
+            self._entries[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def delete(self, key, expected=None):
+        """
+        Delete `key`, or only if it still holds `expected` when given.
+        """
+        with self._lock:
+            entry = self._live(key, time.time())
+            if entry is not None and (expected is None or entry[0] == expected):
+                del self._entries[key]
+
+    def refresh(self, key, expected, ttl):
+        """
+        Extend the TTL of `key` if it still holds `expected`; returns whether
+        it did.
+        """
+        with self._lock:
+            now = time.time()
+            entry = self._live(key, now)
+            if entry is None or entry[0] != expected:
+                return False
+            self._entries[key] = (expected, now + ttl)
+            return True
+
+
+class SQLiteBackend:
+    """
+    Backend for several ComfyUI processes on one host, using SQLite's file
+    locking.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _expire(conn, key):
+        conn.execute(
+            "DELETE FROM entries WHERE key = ? AND expires IS NOT NULL AND expires <= ?",
+            (key, time.time()),
+        )
+
+    def get(self, key):
+        with self._connect() as conn:
+            self._expire(conn, key)
+            row = conn.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, value, expires)
+            )
+
+    def add(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._connect() as conn:
+            self._expire(conn, key)
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO entries VALUES (?, ?, ?)", (key, value, expires)
+            )
+        return cursor.rowcount == 1
+
+    def delete(self, key, expected=None):
+        with self._connect() as conn:
+            if expected is None:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            else:
+                conn.execute(
+                    "DELETE FROM entries WHERE key = ? AND value = ?", (key, expected)
+                )
+
+    def refresh(self, key, expected, ttl):
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE entries SET expires = ? WHERE key = ? AND value = ? "
+                "AND (expires IS NULL OR expires > ?)",
+                (now + ttl, key, expected, now),
+            )
+        return cursor.rowcount == 1
+
+
+class RedisBackend:
+    """
+    Backend for workers on several hosts. Any Redis-compatible server works;
+    pass `client` to use an existing connection (e.g. fakeredis in tests).
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", client=None):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError(
+                "The redis coordination backend requires the redis package: pip install redis"
+            )
+        self._watch_error = redis.WatchError
+        self.client = client or redis.Redis.from_url(url, decode_responses=True)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=math.ceil(ttl) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(
+            self.client.set(key, value, ex=math.ceil(ttl) if ttl else None, nx=True)
+        )
+
+    def delete(self, key, expected=None):
+        if expected is None:
+            self.client.delete(key)
+            return
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                value = pipe.get(key)
+                if isinstance(value, bytes):
+                    value = value.decode()
+                if value == expected:
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+            except self._watch_error:
+                # The key changed hands while we looked; it is no longer ours.
+                pass
+
+    def refresh(self, key, expected, ttl):
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                value = pipe.get(key)
+                if isinstance(value, bytes):
+                    value = value.decode()
+                if value != expected:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.expire(key, math.ceil(ttl))
+                pipe.execute()
+                return True
+            except self._watch_error:
+                return False
+
+
+class Coordinator:
+    """
+    Shares generation results, deduplicates identical in-flight requests and
+    splits a global concurrency budget between workers using one backend.
+    """
+
+    def __init__(
+        self,
+        backend,
+        cache_results=False,
+        result_ttl=86400,
+        max_concurrent=0,
+        lease=3600,
+        poll_interval=2,
+        sleep=time.sleep,
+        async_sleep=asyncio.sleep,
+    ):
+        self.backend = backend
+        self.cache_results = cache_results
+        self.result_ttl = result_ttl
+        self.max_concurrent = max_concurrent
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.sleep = sleep
+        self.async_sleep = async_sleep
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Claims and slots held by this worker, renewed by a heartbeat thread
+        # so a generation that runs (and retries) longer than `lease` keeps
+        # them; they only expire if the worker dies.
+        self._held = {}
+        self._held_lock = threading.Lock()
+        self._heartbeat = None
+
+    def _hold(self, key, value):
+        with self._held_lock:
+            self._held[key] = value
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(
+                    target=self._renew_leases, name="lumaai-lease-heartbeat", daemon=True
+                )
+                self._heartbeat.start()
+
+    def _release(self, key):
+        with self._held_lock:
+            self._held.pop(key, None)
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(max(1.0, self.lease / 3))
+            with self._held_lock:
+                held = list(self._held.items())
+            for key, value in held:
+                try:
+                    if not self.backend.refresh(key, value, self.lease):
+                        print(f"Warning: lost coordination lease {key}")
+                        self._release(key)
+                except Exception as e:
+                    print(f"Warning: could not renew coordination lease {key}: {e}")
+
+    @staticmethod
+    def request_key(kind, request):
+        payload = json.dumps([kind, request], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def try_claim(self, key, waited=False):
+        """
+        One attempt at claiming `key`. Returns (True, generation_id) when an
+        identical request already finished, (True, None) once this worker owns
+        the request, and (False, None) while another worker is running it.
+        """
+        if self.cache_results or waited:
+            generation_id = self.backend.get(KEY_PREFIX + "result:" + key)
+            if generation_id:
+                return True, generation_id
+        if self.backend.add(KEY_PREFIX + "inflight:" + key, self.worker_id, self.lease):
+            self._hold(KEY_PREFIX + "inflight:" + key, self.worker_id)
+            return True, None
+        return False, None
+
+    def claim(self, key):
+        """
+        Return the generation ID of a finished identical request, waiting for
+        one in flight on another worker; or None once this worker owns it.
+        """
+        claimed, generation_id = self.try_claim(key)
+        while not claimed:
+            self.sleep(self.poll_interval)
+            claimed, generation_id = self.try_claim(key, waited=True)
+        return generation_id
+
+    async def async_claim(self, key):
+        # Backend calls block (SQLite locks, Redis round trips), so they run
+        # in a thread rather than on the event loop.
+        claimed, generation_id = await asyncio.to_thread(self.try_claim, key)
+        while not claimed:
+            await self.async_sleep(self.poll_interval)
+            claimed, generation_id = await asyncio.to_thread(
+                self.try_claim, key, waited=True
+            )
+        return generation_id
+
+    def complete(self, key, generation_id):
+        # Without result caching, keep the result just long enough for
+        # workers waiting on the same request to pick it up.
+        ttl = self.result_ttl if self.cache_results else max(30, self.poll_interval * 5)
+        self.backend.set(KEY_PREFIX + "result:" + key, generation_id, ttl)
+        self._release(KEY_PREFIX + "inflight:" + key)
+        self.backend.delete(KEY_PREFIX + "inflight:" + key, self.worker_id)
+
+    def abandon(self, key):
+        self._release(KEY_PREFIX + "inflight:" + key)
+        self.backend.delete(KEY_PREFIX + "inflight:" + key, self.worker_id)
+
+    def try_slot(self, token):
+        """
+        Take any free global slot for `token`, returning its name or None.
+        """
+        for index in range(self.max_concurrent):
+            name = f"{KEY_PREFIX}slot:{index}"
+            if self.backend.add(name, token, self.lease):
+                self._hold(name, token)
+                return name
+        return None
+
+    def release_slot(self, name, token):
+        self._release(name)
+        self.backend.delete(name, token)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Hold one of `max_concurrent` global slots; leases expire so a crashed
+        worker cannot hold a slot forever.
+        """
+        if not self.max_concurrent:
+            yield
+            return
+        token = f"{self.worker_id}:{uuid.uuid4().hex[:8]}"
+        name = self.try_slot(token)
+        while name is None:
+            self.sleep(self.poll_interval)
+            name = self.try_slot(token)
+        try:
+            yield
+        finally:
+            self.release_slot(name, token)
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self):
+        if not self.max_concurrent:
+            yield
+            return
+        token = f"{self.worker_id}:{uuid.uuid4().hex[:8]}"
+        name = await asyncio.to_thread(self.try_slot, token)
+        while name is None:
+            await self.async_sleep(self.poll_interval)
+            name = await asyncio.to_thread(self.try_slot, token)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self.release_slot, name, token)
+
+
+def coordinator_from_config(config, sleep=time.sleep, async_sleep=asyncio.sleep):
+    """
+    Build a Coordinator from the [Coordination] section of config.ini, or
+    return None when no backend is configured.
+    """
+    section = "Coordination"
+    backend_name = config.get(section, "BACKEND", fallback="none").strip().lower()
+    if backend_name in ("", "none"):
+        return None
+    if backend_name == "local":
+        backend = LocalBackend()
+    elif backend_name == "sqlite":
+        path = config.get(section, "SQLITE_PATH", fallback="") or os.path.join(
+            tempfile.gettempdir(), "comfyui-lumaai.sqlite"
+        )
+        backend = SQLiteBackend(path)
+    elif backend_name == "redis":
+        backend = RedisBackend(
+            config.get(section, "REDIS_URL", fallback="") or "redis://localhost:6379/0"
+        )
+    else:
+        raise ValueError(f"Unknown coordination backend: {backend_name}")
+
+    return Coordinator(
+        backend,
+        cache_results=config.getboolean(section, "CACHE_RESULTS", fallback=False),
+        result_ttl=config.getint(section, "RESULT_TTL", fallback=86400),
+        max_concurrent=config.getint(section, "MAX_CONCURRENT", fallback=0),
+        lease=config.getint(section, "LEASE", fallback=3600),
+        sleep=sleep,
+        async_sleep=async_sleep,
+    )
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Generations in these states never change again, so they can be cached
+# until evicted; anything else is only cached for a short TTL.
+TERMINAL_STATES = ("completed", "failed")
+
+
+class GenerationCache:
+    """
+    Bounded LRU memoization of `client.generations.get`, shared by every node
+    in the process. Counts hits so the number of API calls saved is visible.
+    """
+
+    def __init__(self, max_size=1024, ttl=0.5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, generation_id):
+        with self._lock:
+            entry = self._entries.get(generation_id)
+            if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+                self._entries.pop(generation_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(generation_id)
+            self.hits += 1
+            return entry[0]
+
+    def store(self, generation):
+        expires = None if generation.state in TERMINAL_STATES else time.time() + self.ttl
+        with self._lock:
+            self._entries[generation.id] = (generation, expires)
+            self._entries.move_to_end(generation.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return generation
+
+    def invalidate(self, generation_id):
+        with self._lock:
+            self._entries.pop(generation_id, None)
+
+    def get(self, client, generation_id):
+        generation = self.lookup(generation_id)
+        if generation is None:
+            generation = self.store(client.generations.get(id=generation_id))
+        return generation
+
+    async def async_get(self, client, generation_id):
+        generation = self.lookup(generation_id)
+        if generation is None:
+            generation = self.store(await client.generations.get(id=generation_id))
+        return generation
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "api_calls_saved": self.hits,
+            }
+
+
+def source_generation_ids(kind, request):
+    """
+    IDs of existing generations a request builds on.
+    """
+    if kind in ("upscale", "audio"):
+        return [request["id"]]
+    keyframes = request.get("keyframes") or {}
+    return [
+        frame["id"] for frame in keyframes.values() if frame.get("type") == "generation"
+    ]
+
+
+def check_source(generation):
+    if generation.state != "completed":
+        raise ValueError(
+            f"Generation {generation.id} must be completed before it can be used, "
+            f"but it is {generation.state}"
+        )
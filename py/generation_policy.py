@@ -0,0 +1,173 @@
+import json
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+
+# Substrings of `failure_reason` that mean resubmitting the same request
+# cannot succeed (content moderation, bad inputs, billing).
+TERMINAL_FAILURE_MARKERS = (
+    "moderation",
+    "policy",
+    "safety",
+    "invalid",
+    "not allowed",
+    "unsupported",
+    "not found",
+    "insufficient",
+    "credit",
+)
+
+
+class GenerationFailed(ValueError):
+    def __init__(self, generation_id, failure_reason):
+        super().__init__(f"Generation failed: {failure_reason}")
+        self.generation_id = generation_id
+        self.failure_reason = failure_reason or ""
+
+
+class GenerationStalled(GenerationFailed):
+    def __init__(self, generation_id, state, elapsed):
+        super().__init__(
+            generation_id, f"stalled in '{state}' for {elapsed:.0f}s"
+        )
+        self.state = state
+        self.elapsed = elapsed
+
+
+def is_retryable(failure_reason):
+    """
+    Classify a failure reason; anything not known to be terminal is retried.
+    """
+    reason = (failure_reason or "").lower()
+    return not any(marker in reason for marker in TERMINAL_FAILURE_MARKERS)
+
+
+def duration_key(kind, request):
+    """
+    What a generation's duration depends on: its model (or kind, for
+    upscales and audio), output resolution and video length.
+    """
+    return (request.get("model", kind), request.get("resolution"), request.get("duration"))
+
+
+class DurationTracker:
+    """
+    Rolling record of how long completed generations took, per duration_key,
+    used to tell a slow generation from a stalled one.
+    """
+
+    def __init__(self, default_timeout=1800, stall_factor=3.0, min_samples=5, window=50):
+        self.default_timeout = default_timeout
+        self.stall_factor = stall_factor
+        self.min_samples = min_samples
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, key, duration):
+        with self._lock:
+            self._samples[key].append(duration)
+
+    def expected(self, key):
+        """
+        Median duration for `key`, or None until enough samples exist.
+        """
+        with self._lock:
+            samples = list(self._samples[key])
+        if len(samples) < self.min_samples:
+            return None
+        return statistics.median(samples)
+
+    def stall_timeout(self, key):
+        with self._lock:
+            samples = sorted(self._samples[key])
+        if len(samples) < self.min_samples:
+            return self.default_timeout
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        # Never declare a stall sooner than a minute, however fast the model is.
+        return max(60.0, p95 * self.stall_factor)
+
+
+class GenerationStats:
+    """
+    Counts generation outcomes per model so retry rates can be measured.
+    Optionally appends every outcome as a JSON line to `log_path`.
+    """
+
+    def __init__(self, log_path=""):
+        self.log_path = log_path
+        self._counts = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def record(self, model, outcome, generation_id=None, reason=None):
+        with self._lock:
+            self._counts[model][outcome] += 1
+            if self.log_path:
+                entry = {
+                    "time": time.time(),
+                    "model": model,
+                    "outcome": outcome,
+                    "generation_id": generation_id,
+                    "reason": reason,
+                }
+                # Outcomes are recorded after a generation was paid for, so
+                # a bad log path must not fail it.
+                try:
+                    with open(self.log_path, "a") as file:
+                        file.write(json.dumps(entry) + "\n")
+                except OSError as e:
+                    print(f"Warning: could not write outcome log {self.log_path}: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            return {model: dict(counts) for model, counts in self._counts.items()}
+
+    def retry_rate(self, model=None):
+        """
+        Fraction of submissions that were resubmissions of a failed attempt.
+        """
+        snapshot = self.snapshot()
+        models = [model] if model is not None else list(snapshot)
+        retried = sum(snapshot.get(m, {}).get("retried", 0) for m in models)
+        submitted = sum(snapshot.get(m, {}).get("submitted", 0) for m in models)
+        return retried / submitted if submitted else 0.0
+
+
+class RetryPolicy:
+    """
+    Bounded resubmission of retryable failures and stalls, with an optional
+    fallback model used for retries or when a deadline would otherwise be
+    missed.
+    """
+
+    def __init__(self, max_retries=2, fallback_model="", deadline=0, durations=None, stats=None):
+        self.max_retries = max_retries
+        self.fallback_model = fallback_model
+        self.deadline = deadline
+        self.durations = durations if durations is not None else DurationTracker()
+        self.stats = stats if stats is not None else GenerationStats()
+
+    def should_retry(self, error, attempt):
+        if attempt >= self.max_retries:
+            return False
+        if isinstance(error, GenerationStalled):
+            return True
+        return is_retryable(error.failure_reason)
+
+    def choose_model(self, request, started, attempt):
+        """
+        Model to submit a video request with: the fallback once a retry is
+        needed, or as soon as the requested model is not expected to finish
+        before the deadline.
+        """
+        model = request.get("model")
+        if not self.fallback_model or model is None or model == self.fallback_model:
+            return model
+        if attempt > 0:
+            return self.fallback_model
+        if self.deadline:
+            expected = self.durations.expected(duration_key("video", request))
+            remaining = self.deadline - (time.time() - started)
+            if expected is not None and expected > remaining:
+                return self.fallback_model
+        return model
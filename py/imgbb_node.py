@@ -1,9 +1,9 @@
 # Based on https://github.com/revirevy/Comfyui_saveimage_imgbb/blob/main/ImgBBUploader.py
 import requests
 import base64
-from PIL import Image
-import io
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from .reference_preprocess import FORMATS, MAX_REFERENCE_SIZE, preprocess_references
 
 
 class ImgBBUpload:
@@ -19,40 +19,53 @@ class ImgBBUpload:
                     {"default": 60, "min": 60, "max": 15552000, "step": 1},
                 ),
             },
+            "optional": {
+                "max_size": (
+                    "INT",
+                    {"default": MAX_REFERENCE_SIZE, "min": 0, "max": 8192, "step": 8},
+                ),
+                "format": (FORMATS,),
+                "quality": ("INT", {"default": 90, "min": 1, "max": 100, "step": 1}),
+            },
         }
 
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("image_url",)
+    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_NAMES = ("image_url", "image_urls")
 
     FUNCTION = "upload"
 
     CATEGORY = "image/upload"
 
-    def upload(self, image, api_key, expire, expiration_time):
+    def upload(
+        self,
+        image,
+        api_key,
+        expire,
+        expiration_time,
+        max_size=MAX_REFERENCE_SIZE,
+        format="JPEG",
+        quality=90,
+    ):
         """
-        Upload an image to ImgBB and return the URL.
+        Upload every image of the batch to ImgBB, downscaled to `max_size` and
+        re-encoded first. Returns the first URL and all URLs, one per line.
         """
         if not api_key:
             raise ValueError("API Key is required")
 
-        # Convert image tensor to PIL Image
-        img = image[0]
-        img = 255.0 * img.cpu().numpy()
-        img = Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
-
-        # Save PIL Image to buffer
-        buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
-        buffer.seek(0)
-
-        base64_image = base64.b64encode(buffer.getvalue()).decode("utf-8")
-
         url = f"https://api.imgbb.com/1/upload?key={api_key}"
         if expire:
             url += f"&expiration={expiration_time}"
 
+        encoded = preprocess_references(image, max_size, format, quality)
+        with ThreadPoolExecutor(max_workers=min(len(encoded), 4)) as executor:
+            urls = list(executor.map(lambda data: self.upload_one(url, data), encoded))
+
+        return (urls[0], "\n".join(urls))
+
+    def upload_one(self, url, data):
         payload = {
-            "image": base64_image,
+            "image": base64.b64encode(data).decode("utf-8"),
         }
 
         try:
@@ -60,7 +73,7 @@ class ImgBBUpload:
             result = response.json()
 
             if result.get("success"):
-                return (result["data"]["url"],)
+                return result["data"]["url"]
             else:
                 error_message = result.get("error", {}).get("message", "Unknown error")
                 raise ValueError(f"Error: {error_message}")
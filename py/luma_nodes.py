@@ -13,7 +13,18 @@ from .lumaai_api_node import (
     AddAudio2Video,
     UpscaleGeneration,
 )
+from .async_nodes import (
+    AsyncText2Video,
+    AsyncImage2Video,
+    AsyncInterpolateGenerations,
+    AsyncExtendGeneration,
+    AsyncImageGeneration,
+    AsyncModifyImage,
+    AsyncAddAudio2Video,
+    AsyncUpscaleGeneration,
+)
 from .imgbb_node import ImgBBUpload
+from .pipeline_node import Pipeline
 
 NODE_CLASS_MAPPINGS = {
     "LumaAIClient": LumaAIClient,
@@ -30,6 +41,15 @@ NODE_CLASS_MAPPINGS = {
     "LumaModifyImage": ModifyImage,
     "LumaAddAudio2Video": AddAudio2Video,
     "LumaUpscaleGeneration": UpscaleGeneration,
+    "LumaPipeline": Pipeline,
+    "LumaText2VideoAsync": AsyncText2Video,
+    "LumaImage2VideoAsync": AsyncImage2Video,
+    "LumaInterpolateGenerationsAsync": AsyncInterpolateGenerations,
+    "LumaExtendGenerationAsync": AsyncExtendGeneration,
+    "LumaImageGenerationAsync": AsyncImageGeneration,
+    "LumaModifyImageAsync": AsyncModifyImage,
+    "LumaAddAudio2VideoAsync": AsyncAddAudio2Video,
+    "LumaUpscaleGenerationAsync": AsyncUpscaleGeneration,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
@@ -47,4 +67,13 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "LumaModifyImage": "Modify Image",
     "LumaAddAudio2Video": "Add Audio to Video",
     "LumaUpscaleGeneration": "Upscale Generation",
+    "LumaPipeline": "Generation Pipeline",
+    "LumaText2VideoAsync": "Text to Video (Async)",
+    "LumaImage2VideoAsync": "Image to Video (Async)",
+    "LumaInterpolateGenerationsAsync": "Interpolate Generations (Async)",
+    "LumaExtendGenerationAsync": "Extend Generation (Async)",
+    "LumaImageGenerationAsync": "Image Generation (Async)",
+    "LumaModifyImageAsync": "Modify Image (Async)",
+    "LumaAddAudio2VideoAsync": "Add Audio to Video (Async)",
+    "LumaUpscaleGenerationAsync": "Upscale Generation (Async)",
 }
@@ -1,9 +1,29 @@
 import configparser
 import os
-import requests
 import time
+from comfy.model_management import InterruptProcessingException
 from lumaai import LumaAI
 
+from .accounting import Accountant, parse_prices
+from .asset_store import AssetStore
+from .coordination import coordinator_from_config
+from .generation_cache import GenerationCache, check_source, source_generation_ids
+from .generation_policy import (
+    DurationTracker,
+    GenerationFailed,
+    GenerationStalled,
+    GenerationStats,
+    RetryPolicy,
+    duration_key,
+)
+from .progress import (
+    GenerationProgress,
+    current_prompt_id,
+    download_file,
+    interruptible_sleep,
+    queued_prompts,
+)
+
 import folder_paths
 import nodes
 
@@ -24,11 +44,45 @@ except KeyError:
     print("Error: LUMAAI_API_KEY not found in config.ini")
 
 
-def download_file(url, file_name):
-    response = requests.get(url, stream=True)
-    with open(file_name, "wb") as file:
-        file.write(response.content)
-    print(f"File downloaded as {file_name}")
+retry_policy = RetryPolicy(
+    max_retries=config.getint("Retry", "MAX_RETRIES", fallback=2),
+    fallback_model=config.get("Retry", "FALLBACK_MODEL", fallback=""),
+    deadline=config.getint("Retry", "DEADLINE", fallback=0),
+    durations=DurationTracker(
+        default_timeout=config.getint("Retry", "STALL_TIMEOUT", fallback=1800),
+        stall_factor=config.getfloat("Retry", "STALL_FACTOR", fallback=3.0),
+    ),
+    stats=GenerationStats(config.get("Retry", "OUTCOME_LOG", fallback="")),
+)
+
+coordinator = coordinator_from_config(config, sleep=interruptible_sleep)
+
+# The extension's own directory may be read-only, so the ledger defaults to
+# ComfyUI's user directory (the output directory on older ComfyUI versions).
+ledger_dir = getattr(folder_paths, "get_user_directory", folder_paths.get_output_directory)()
+accountant = Accountant(
+    config.get("Budget", "LEDGER", fallback="") or os.path.join(ledger_dir, "lumaai_spend.sqlite"),
+    daily_budget=config.getfloat("Budget", "DAILY_BUDGET", fallback=0),
+    workflow_budget=config.getfloat("Budget", "WORKFLOW_BUDGET", fallback=0),
+    auto_downgrade=config.getboolean("Budget", "AUTO_DOWNGRADE", fallback=False),
+    prices=parse_prices(config.get("Budget", "PRICES", fallback="")),
+    pending_jobs=queued_prompts,
+)
+
+generation_cache = GenerationCache(
+    max_size=config.getint("GenerationCache", "MAX_SIZE", fallback=1024),
+    ttl=config.getfloat("GenerationCache", "TTL", fallback=0.5),
+)
+
+delete_on_cancel = config.getboolean("Cancellation", "DELETE_ON_CANCEL", fallback=False)
+
+asset_store = None
+if config.getboolean("AssetStore", "ENABLED", fallback=False):
+    asset_store = AssetStore(
+        config.get("AssetStore", "ROOT", fallback="")
+        or os.path.join(folder_paths.get_output_directory(), "luma_assets"),
+        budget=int(config.getfloat("AssetStore", "BUDGET_GB", fallback=0) * 1024**3),
+    )
 
 
 def parse_filename(filename):
@@ -53,27 +107,186 @@ def parse_filename(filename):
     return directory, filename
 
 
-def wait_for_generation(client, generation_id, save, filename, output_dir):
-    completed = False
-    while not completed:
-        generation = client.generations.get(id=generation_id)
-        if generation.state == "completed":
-            completed = True
-        elif generation.state == "failed":
-            raise ValueError(f"Generation failed: {generation.failure_reason}")
-        time.sleep(3)
+def create_generation(client, kind, request):
+    if kind == "image":
+        return client.generations.image.create(**request)
+    if kind == "upscale":
+        return client.generations.upscale(**request)
+    if kind == "audio":
+        return client.generations.audio(**request)
+    return client.generations.create(**request)
+
+
+def wait_for_generation(
+    client, generation_id, interval=3, stall_timeout=None, progress=None, expected=None
+):
+    started = time.time()
+    try:
+        while True:
+            generation = generation_cache.get(client, generation_id)
+            elapsed = time.time() - started
+            if progress is not None:
+                progress.generation(generation_id, generation.state, elapsed, expected)
+            if generation.state == "completed":
+                return generation
+            if generation.state == "failed":
+                raise GenerationFailed(generation_id, generation.failure_reason)
+            if stall_timeout is not None and elapsed > stall_timeout:
+                raise GenerationStalled(generation_id, generation.state, elapsed)
+            interruptible_sleep(interval)
+    except InterruptProcessingException:
+        if delete_on_cancel:
+            try:
+                client.generations.delete(id=generation_id)
+                generation_cache.invalidate(generation_id)
+                print(f"Deleted cancelled generation {generation_id}")
+            except Exception as e:
+                print(f"Could not delete cancelled generation {generation_id}: {e}")
+        raise
+
+
+def run_generation(client, kind, request, interval=3, policy=None, progress=None):
+    """
+    Submit a generation and wait for it, reusing the result of an identical
+    request from any worker sharing the coordination backend.
+    """
+    # Fail fast if a source generation is unusable; sources produced earlier
+    # in the workflow are served from the cache.
+    for source_id in source_generation_ids(kind, request):
+        check_source(generation_cache.get(client, source_id))
+
+    if coordinator is None:
+        return submit_within_budget(client, kind, request, interval, policy, progress)
+
+    key = coordinator.request_key(kind, request)
+    generation_id = coordinator.claim(key)
+    if generation_id is not None:
+        print(f"Reusing generation {generation_id} from an identical request")
+        return generation_cache.get(client, generation_id)
+
+    try:
+        with coordinator.slot():
+            generation = submit_within_budget(
+                client, kind, request, interval, policy, progress
+            )
+    except BaseException:
+        coordinator.abandon(key)
+        raise
+    coordinator.complete(key, generation.id)
+    return generation
+
+
+def submit_within_budget(client, kind, request, interval=3, policy=None, progress=None):
+    """
+    Check the request against the budget (possibly downgrading it), run it,
+    and record what it cost.
+    """
+    workflow = current_prompt_id()
+    with accountant.charge(kind, request, workflow) as request:
+        generation = submit_with_retries(client, kind, request, interval, policy, progress)
+        if kind == "video" and getattr(generation, "model", None):
+            # The retry policy may have fallen back to another model.
+            request = dict(request, model=generation.model)
+        # Recorded before the reservation is released, so the cost is never
+        # missing from both.
+        accountant.record(generation.id, kind, request, workflow)
+    return generation
+
+
+def submit_with_retries(client, kind, request, interval=3, policy=None, progress=None):
+    """
+    Submit a generation and wait for it, resubmitting retryable failures and
+    stalls according to the retry policy. Returns the completed generation.
+    """
+    policy = policy or retry_policy
+    request = dict(request)
+    started = time.time()
+    attempt = 0
+    while True:
+        if kind == "video":
+            request["model"] = policy.choose_model(request, started, attempt)
+        model = request.get("model", kind)
+        key = duration_key(kind, request)
+
+        generation = create_generation(client, kind, request)
+        policy.stats.record(model, "submitted", generation.id)
+        submitted = time.time()
+        try:
+            generation = wait_for_generation(
+                client,
+                generation.id,
+                interval,
+                policy.durations.stall_timeout(key),
+                progress,
+                policy.durations.expected(key),
+            )
+        except GenerationFailed as e:
+            if isinstance(e, GenerationStalled):
+                # Don't leave an abandoned generation running in the background.
+                try:
+                    client.generations.delete(id=e.generation_id)
+                    generation_cache.invalidate(e.generation_id)
+                except Exception:
+                    pass
+            if not policy.should_retry(e, attempt):
+                outcome = "stalled" if isinstance(e, GenerationStalled) else "failed"
+                policy.stats.record(model, outcome, e.generation_id, e.failure_reason)
+                raise
+            attempt += 1
+            policy.stats.record(model, "retried", e.generation_id, e.failure_reason)
+            print(
+                f"Retrying generation {e.generation_id} ({e.failure_reason}), "
+                f"attempt {attempt}/{policy.max_retries}"
+            )
+            continue
+
+        policy.durations.record(key, time.time() - submitted)
+        policy.stats.record(model, "completed", generation.id)
+        return generation
+
+
+def asset_path(generation_id, filename, extension, output_dir):
+    """
+    Resolve where an asset is saved, and whether the asset store must keep
+    it (pinned) rather than evict it.
+    """
+    directory, filename = parse_filename(filename)
+    if asset_store is not None and directory == "" and filename == "":
+        # Unnamed outputs live in the store's sharded layout and may be evicted.
+        return asset_store.default_path(output_dir, generation_id, extension), False
+
+    if filename == "":
+        filename = generation_id
+    return os.path.join(output_dir, directory, filename + extension), True
 
+
+def save_asset(generation_id, url, filename, extension, output_dir, progress=None):
+    """
+    Save a generation's asset under `filename`, returning the local path.
+    """
+    path, pinned = asset_path(generation_id, filename, extension, output_dir)
+    if asset_store is not None:
+        return asset_store.fetch(generation_id, url, path, pinned, progress)
+    download_file(url, path, progress)
+    print(f"File downloaded as {path}")
+    return path
+
+
+def save_video(generation, save, filename, output_dir, progress=None):
     video_url = generation.assets.video
     if save:
-        directory, filename = parse_filename(filename)
-        if filename == "":
-            filename = generation_id
-        download_file(
-            video_url, os.path.join(output_dir, directory, filename + ".mp4")
-        )
+        save_asset(generation.id, video_url, filename, ".mp4", output_dir, progress)
     return video_url
 
 
+def save_image(generation, filename, output_dir, progress=None):
+    image_url = generation.assets.image
+    path = save_asset(generation.id, image_url, filename, ".jpg", output_dir, progress)
+
+    image, _ = nodes.LoadImage().load_image(path)
+    return image_url, image
+
+
 class LumaAIClient:
     @classmethod
     def INPUT_TYPES(cls):
@@ -138,14 +351,11 @@ class Text2Video:
     FUNCTION = "run"
     CATEGORY = "LumaAI/Ray"
 
-    def run(self, client, model, prompt, duration, loop, aspect_ratio, resolution, save, filename):
-        """
-        Generate a video from a text prompt.
-        """
+    def build_request(self, model, prompt, duration, loop, aspect_ratio, resolution):
         if prompt == "":
             raise ValueError("Prompt is required")
 
-        generation = client.generations.create(
+        return "video", dict(
             prompt=prompt,
             model=model,
             loop=loop,
@@ -153,8 +363,19 @@ class Text2Video:
             duration=duration,
             resolution=resolution,
         )
+
+    def run(self, client, model, prompt, duration, loop, aspect_ratio, resolution, save, filename):
+        """
+        Generate a video from a text prompt.
+        """
+        kind, request = self.build_request(
+            model, prompt, duration, loop, aspect_ratio, resolution
+        )
+
+        progress = GenerationProgress()
+        generation = run_generation(client, kind, request, progress=progress)
         generation_id = generation.id
-        video_url = wait_for_generation(client, generation_id, save, filename, self.output_dir)
+        video_url = save_video(generation, save, filename, self.output_dir, progress)
 
         return {
             "ui": {"text": [generation_id]},
@@ -197,22 +418,16 @@ class Image2Video:
     FUNCTION = "run"
     CATEGORY = "LumaAI/Ray"
 
-    def run(
+    def build_request(
         self,
-        client,
         model,
         prompt,
         duration,
         loop,
         resolution,
-        save,
         init_image_url="",
         final_image_url="",
-        filename="",
     ):
-        """
-        Generate a video from an image prompt.
-        """
         if init_image_url == "" and final_image_url == "":
             raise ValueError("At least one image URL is required")
 
@@ -222,7 +437,7 @@ class Image2Video:
         if final_image_url != "":
             keyframes["frame1"] = {"type": "image", "url": final_image_url}
 
-        generation = client.generations.create(
+        return "video", dict(
             prompt=prompt,
             model=model,
             loop=loop,
@@ -230,8 +445,31 @@ class Image2Video:
             resolution=resolution,
             keyframes=keyframes,
         )
+
+    def run(
+        self,
+        client,
+        model,
+        prompt,
+        duration,
+        loop,
+        resolution,
+        save,
+        init_image_url="",
+        final_image_url="",
+        filename="",
+    ):
+        """
+        Generate a video from an image prompt.
+        """
+        kind, request = self.build_request(
+            model, prompt, duration, loop, resolution, init_image_url, final_image_url
+        )
+
+        progress = GenerationProgress()
+        generation = run_generation(client, kind, request, progress=progress)
         generation_id = generation.id
-        video_url = wait_for_generation(client, generation_id, save, filename, self.output_dir)
+        video_url = save_video(generation, save, filename, self.output_dir, progress)
 
         return {
             "ui": {"text": [generation_id]},
@@ -270,6 +508,20 @@ class InterpolateGenerations:
     FUNCTION = "run"
     CATEGORY = "LumaAI/Ray"
 
+    def build_request(self, model, prompt, resolution, generation_id_1, generation_id_2):
+        if not generation_id_1 or not generation_id_2:
+            raise ValueError("Both generation IDs are required")
+
+        return "video", dict(
+            prompt=prompt,
+            keyframes={
+                "frame0": {"type": "generation", "id": generation_id_1},
+                "frame1": {"type": "generation", "id": generation_id_2},
+            },
+            model=model,
+            resolution=resolution,
+        )
+
     def run(
         self,
         client,
@@ -284,20 +536,14 @@ class InterpolateGenerations:
         """
         Generate a video by interpolating between two existing generations.
         """
-        if not generation_id_1 or not generation_id_2:
-            raise ValueError("Both generation IDs are required")
-
-        generation = client.generations.create(
-            prompt=prompt,
-            keyframes={
-                "frame0": {"type": "generation", "id": generation_id_1},
-                "frame1": {"type": "generation", "id": generation_id_2},
-            },
-            model=model,
-            resolution=resolution,
+        kind, request = self.build_request(
+            model, prompt, resolution, generation_id_1, generation_id_2
         )
+
+        progress = GenerationProgress()
+        generation = run_generation(client, kind, request, progress=progress)
         generation_id = generation.id
-        video_url = wait_for_generation(client, generation_id, save, filename, self.output_dir)
+        video_url = save_video(generation, save, filename, self.output_dir, progress)
 
         return {
             "ui": {"text": [generation_id]},
@@ -341,23 +587,17 @@ class ExtendGeneration:
     FUNCTION = "run"
     CATEGORY = "LumaAI/Ray"
 
-    def run(
+    def build_request(
         self,
-        client,
         model,
         prompt,
         loop,
         resolution,
-        save,
         init_image_url="",
         final_image_url="",
         init_generation_id="",
         final_generation_id="",
-        filename="",
     ):
-        """
-        Generate a video by extending from an image to an existing generation.
-        """
         if not init_generation_id and not final_generation_id:
             raise ValueError("You must provide at least one generation id")
         if init_image_url and init_generation_id:
@@ -379,15 +619,46 @@ class ExtendGeneration:
         if final_generation_id != "":
             keyframes["frame1"] = {"type": "generation", "id": final_generation_id}
 
-        generation = client.generations.create(
+        return "video", dict(
             prompt=prompt,
             model=model,
             loop=loop,
             resolution=resolution,
             keyframes=keyframes,
         )
+
+    def run(
+        self,
+        client,
+        model,
+        prompt,
+        loop,
+        resolution,
+        save,
+        init_image_url="",
+        final_image_url="",
+        init_generation_id="",
+        final_generation_id="",
+        filename="",
+    ):
+        """
+        Generate a video by extending from an image to an existing generation.
+        """
+        kind, request = self.build_request(
+            model,
+            prompt,
+            loop,
+            resolution,
+            init_image_url,
+            final_image_url,
+            init_generation_id,
+            final_generation_id,
+        )
+
+        progress = GenerationProgress()
+        generation = run_generation(client, kind, request, progress=progress)
         generation_id = generation.id
-        video_url = wait_for_generation(client, generation_id, save, filename, self.output_dir)
+        video_url = save_video(generation, save, filename, self.output_dir, progress)
 
         return {
             "ui": {"text": [generation_id]},
@@ -421,6 +692,9 @@ class UpscaleGeneration:
     FUNCTION = "run"
     CATEGORY = "LumaAI/Upscale"
 
+    def build_request(self, generation_id, resolution):
+        return "upscale", dict(id=generation_id, resolution=resolution)
+
     def run(
         self,
         client,
@@ -432,9 +706,11 @@ class UpscaleGeneration:
         """
         Upscale a generation.
         """
-        generation = client.generations.upscale(id=generation_id, resolution=resolution)
+        kind, request = self.build_request(generation_id, resolution)
+        progress = GenerationProgress()
+        generation = run_generation(client, kind, request, progress=progress)
         upscaled_generation_id = generation.id
-        video_url = wait_for_generation(client, upscaled_generation_id, save, filename, self.output_dir)
+        video_url = save_video(generation, save, filename, self.output_dir, progress)
 
         return {
             "ui": {"text": [upscaled_generation_id]},
@@ -473,6 +749,11 @@ class AddAudio2Video:
     FUNCTION = "run"
     CATEGORY = "LumaAI/Audio"
 
+    def build_request(self, generation_id, prompt, negative_prompt):
+        return "audio", dict(
+            id=generation_id, prompt=prompt, negative_prompt=negative_prompt
+        )
+
     def run(
         self,
         client,
@@ -483,11 +764,13 @@ class AddAudio2Video:
         filename="",
     ):
         """
-        Upscale a generation.
+        Add audio to a generation.
         """
-        generation = client.generations.audio(id=generation_id, prompt=prompt, negative_prompt=negative_prompt)
+        kind, request = self.build_request(generation_id, prompt, negative_prompt)
+        progress = GenerationProgress()
+        generation = run_generation(client, kind, request, progress=progress)
         with_audio_generation_id = generation.id
-        video_url = wait_for_generation(client, with_audio_generation_id, save, filename, self.output_dir)
+        video_url = save_video(generation, save, filename, self.output_dir, progress)
 
         return {
             "ui": {"text": [with_audio_generation_id]},
@@ -614,7 +897,8 @@ class CharacterReference:
             character_image_url_4,
         ]:
             if url is not None:
-                urls.append(url)
+                # ImgBBUpload's image_urls output holds one URL per line.
+                urls.extend(line.strip() for line in url.splitlines() if line.strip())
         if len(urls) == 0:
             raise ValueError("You must provide at least one character image URL")
 
@@ -653,6 +937,23 @@ class ImageGeneration:
     FUNCTION = "run"
     CATEGORY = "LumaAI/Photon"
 
+    POLL_INTERVAL = 1
+
+    def build_request(
+        self, model, prompt, aspect_ratio, image_ref=None, style_ref=None, character_ref=None
+    ):
+        if style_ref is not None:
+            style_ref = [style_ref]
+
+        return "image", dict(
+            prompt=prompt,
+            model=model,
+            aspect_ratio=aspect_ratio,
+            image_ref=image_ref,
+            style_ref=style_ref,
+            character_ref=character_ref,
+        )
+
     def run(
         self,
         client,
@@ -667,39 +968,15 @@ class ImageGeneration:
         """
         Generate an image from a text prompt and optional references.
         """
-        if style_ref is not None:
-            style_ref = [style_ref]
-
-        generation = client.generations.image.create(
-            prompt=prompt,
-            model=model,
-            aspect_ratio=aspect_ratio,
-            image_ref=image_ref,
-            style_ref=style_ref,
-            character_ref=character_ref,
+        kind, request = self.build_request(
+            model, prompt, aspect_ratio, image_ref, style_ref, character_ref
         )
-
-        generation_id = generation.id
-        completed = False
-        while not completed:
-            generation = client.generations.get(id=generation_id)
-            if generation.state == "completed":
-                completed = True
-            elif generation.state == "failed":
-                raise ValueError(f"Generation failed: {generation.failure_reason}")
-            time.sleep(1)
-
-        image_url = generation.assets.image
-        directory, filename = parse_filename(filename)
-        if filename == "":
-            filename = generation_id
-        download_file(
-            image_url, os.path.join(self.output_dir, directory, filename + ".jpg")
-        )
-
-        image, _ = nodes.LoadImage().load_image(
-            os.path.join(self.output_dir, directory, filename + ".jpg")
+        progress = GenerationProgress()
+        generation = run_generation(
+            client, kind, request, interval=self.POLL_INTERVAL, progress=progress
         )
+        generation_id = generation.id
+        image_url, image = save_image(generation, filename, self.output_dir, progress)
 
         return {
             "ui": {"text": [generation_id]},
@@ -732,37 +1009,22 @@ class ModifyImage:
     FUNCTION = "run"
     CATEGORY = "LumaAI/Photon"
 
+    POLL_INTERVAL = 3
+
+    def build_request(self, model, prompt, modify_image_ref):
+        return "image", dict(prompt=prompt, model=model, modify_image_ref=modify_image_ref)
+
     def run(self, client, model, prompt, modify_image_ref, filename=""):
         """
         Modify an image.
         """
-        generation = client.generations.image.create(
-            prompt=prompt,
-            model=model,
-            modify_image_ref=modify_image_ref,
+        kind, request = self.build_request(model, prompt, modify_image_ref)
+        progress = GenerationProgress()
+        generation = run_generation(
+            client, kind, request, interval=self.POLL_INTERVAL, progress=progress
         )
-
         generation_id = generation.id
-        completed = False
-        while not completed:
-            generation = client.generations.get(id=generation_id)
-            if generation.state == "completed":
-                completed = True
-            elif generation.state == "failed":
-                raise ValueError(f"Generation failed: {generation.failure_reason}")
-            time.sleep(3)
-
-        image_url = generation.assets.image
-        directory, filename = parse_filename(filename)
-        if filename == "":
-            filename = generation_id
-        download_file(
-            image_url, os.path.join(self.output_dir, directory, filename + ".jpg")
-        )
-
-        image, _ = nodes.LoadImage().load_image(
-            os.path.join(self.output_dir, directory, filename + ".jpg")
-        )
+        image_url, image = save_image(generation, filename, self.output_dir, progress)
 
         return {
             "ui": {"text": [generation_id]},
@@ -0,0 +1,268 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import comfy.utils
+import folder_paths
+from comfy.model_management import InterruptProcessingException
+
+from .lumaai_api_node import (
+    AddAudio2Video,
+    ExtendGeneration,
+    Image2Video,
+    Text2Video,
+    UpscaleGeneration,
+    run_generation,
+    save_video,
+)
+from .progress import interrupt_scope
+
+STAGE_TYPES = ("text2video", "image2video", "extend", "upscale", "audio")
+
+
+class StageSkipped(ValueError):
+    """
+    A stage did not run because the stage it depends on failed.
+    """
+
+
+def build_stage_request(stage, source_id):
+    """
+    Translate a stage definition into the (kind, request) pair accepted by
+    run_generation, chaining from the generation of the stage it depends on.
+    Requests are built by the matching node, so stages are validated exactly
+    like the nodes themselves.
+    """
+    stage_type = stage["type"]
+    model = stage.get("model", "ray-2")
+    prompt = stage.get("prompt", "")
+    loop = stage.get("loop", False)
+    resolution = stage.get("resolution", "720p")
+    duration = stage.get("duration", "5s")
+
+    try:
+        if stage_type == "text2video":
+            return Text2Video().build_request(
+                model, prompt, duration, loop, stage.get("aspect_ratio", "16:9"), resolution
+            )
+
+        if stage_type == "image2video":
+            return Image2Video().build_request(
+                model,
+                prompt,
+                duration,
+                loop,
+                resolution,
+                stage.get("init_image_url", ""),
+                stage.get("final_image_url", ""),
+            )
+
+        if stage_type == "extend":
+            # "forward" continues after the source generation, "backward" leads into it.
+            backward = stage.get("direction") == "backward"
+            return ExtendGeneration().build_request(
+                model,
+                prompt,
+                loop,
+                resolution,
+                init_image_url=stage.get("init_image_url", ""),
+                final_image_url=stage.get("final_image_url", ""),
+                init_generation_id="" if backward else source_id,
+                final_generation_id=source_id if backward else "",
+            )
+
+        if stage_type == "upscale":
+            return UpscaleGeneration().build_request(
+                source_id, stage.get("resolution", "1080p")
+            )
+
+        return AddAudio2Video().build_request(
+            source_id, prompt, stage.get("negative_prompt", "")
+        )
+    except ValueError as e:
+        raise ValueError(f"Stage '{stage['name']}': {e}")
+
+
+def stage_file_name(filename, stage_name):
+    """
+    Filename for a saved stage: `filename` joined to the stage name with an
+    underscore, or the stage name inside `filename` if it is a directory.
+    """
+    if not filename:
+        return ""
+    if filename.endswith(("/", os.path.sep)):
+        return filename + stage_name
+    return f"{filename}_{stage_name}"
+
+
+def parse_stages(stages_json):
+    """
+    Parse and validate the stage list.
+    """
+    try:
+        stages = json.loads(stages_json)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Stages must be a JSON list: {e}")
+    if not isinstance(stages, list) or len(stages) == 0:
+        raise ValueError("Stages must be a non-empty JSON list")
+
+    by_name = {}
+    for index, stage in enumerate(stages):
+        if not isinstance(stage, dict):
+            raise ValueError(f"Stage {index} must be a JSON object")
+        stage.setdefault("name", f"stage_{index}")
+        if stage.get("type") not in STAGE_TYPES:
+            raise ValueError(
+                f"Stage '{stage['name']}': type must be one of {', '.join(STAGE_TYPES)}"
+            )
+        if stage["name"] in by_name:
+            raise ValueError(f"Duplicate stage name: {stage['name']}")
+        by_name[stage["name"]] = stage
+
+    for stage in stages:
+        needs_source = stage["type"] in ("extend", "upscale", "audio")
+        source = stage.get("from")
+        if needs_source and source is None:
+            raise ValueError(f"Stage '{stage['name']}' needs a 'from' stage")
+        if not needs_source and source is not None:
+            raise ValueError(f"Stage '{stage['name']}' does not take a 'from' stage")
+        if source is not None and source not in by_name:
+            raise ValueError(f"Stage '{stage['name']}' depends on unknown stage '{source}'")
+
+    dependency_order(stages)
+    # Build every request once up front (with a placeholder source), so an
+    # invalid stage fails before anything is submitted.
+    for stage in stages:
+        build_stage_request(stage, "pending" if stage.get("from") else None)
+    return stages
+
+
+def dependency_order(stages):
+    """
+    Return the stages ordered so every stage comes after its source.
+    """
+    by_name = {stage["name"]: stage for stage in stages}
+    ordered, visiting, done = [], set(), set()
+
+    def visit(stage):
+        if stage["name"] in done:
+            return
+        if stage["name"] in visiting:
+            raise ValueError(f"Stage '{stage['name']}' is part of a dependency cycle")
+        visiting.add(stage["name"])
+        if stage.get("from") is not None:
+            visit(by_name[stage["from"]])
+        visiting.discard(stage["name"])
+        done.add(stage["name"])
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+class Pipeline:
+    def __init__(self):
+        self.output_dir = folder_paths.get_output_directory()
+
+    @classmethod
+    def IS_CHANGED(cls, *args, **kwargs):
+        return float("NaN")
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "client": ("LUMACLIENT", {"forceInput": True}),
+                "stages": ("STRING", {"multiline": True, "default": "[]"}),
+                "save": ("BOOLEAN", {"default": True}),
+            },
+            "optional": {"filename": ("STRING", {"default": ""})},
+        }
+
+    RETURN_TYPES = ("STRING", "STRING", "STRING")
+    RETURN_NAMES = ("video_url", "generation_id", "results")
+    OUTPUT_NODE = True
+    FUNCTION = "run"
+    CATEGORY = "LumaAI/Ray"
+
+    def run(self, client, stages, save, filename=""):
+        """
+        Run a list of generate/extend/upscale/audio stages as a dependency
+        graph. Each stage is submitted as soon as the stage it depends on
+        completes, independent branches run concurrently, and only final
+        stages (or stages with "save": true) are downloaded.
+        """
+        stages = parse_stages(stages)
+        sources = {stage.get("from") for stage in stages}
+        futures = {}
+        bar = comfy.utils.ProgressBar(len(stages))
+        finished = []
+        interrupted = threading.Event()
+
+        def run_stage(stage):
+            source_id = None
+            if stage.get("from") is not None:
+                try:
+                    source_id = futures[stage["from"]].result()[0].id
+                except InterruptProcessingException:
+                    raise
+                except Exception:
+                    raise StageSkipped(stage["name"])
+            kind, request = build_stage_request(stage, source_id)
+            # An interrupt seen by one stage stops the polling and downloads
+            # of all the others too.
+            with interrupt_scope(interrupted):
+                generation = run_generation(client, kind, request)
+                print(f"Pipeline stage '{stage['name']}' completed: {generation.id}")
+                # Downloads happen on the stage's own thread, so one finished
+                # branch is saved while the others are still generating.
+                stage_save = stage.get("save", stage["name"] not in sources)
+                stage_filename = stage_file_name(filename, stage["name"])
+                video_url = save_video(
+                    generation, save and stage_save, stage_filename, self.output_dir
+                )
+            finished.append(stage["name"])
+            bar.update_absolute(len(finished))
+            return generation, video_url
+
+        # One thread per stage: a stage blocks on its source's future, so a
+        # smaller pool could deadlock on deep chains.
+        with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+            # Sources are submitted first so their futures exist when looked up.
+            for stage in dependency_order(stages):
+                futures[stage["name"]] = executor.submit(run_stage, stage)
+
+        if interrupted.is_set():
+            raise InterruptProcessingException()
+
+        results = {}
+        errors = []
+        for stage in stages:
+            try:
+                generation, video_url = futures[stage["name"]].result()
+            except InterruptProcessingException:
+                raise
+            except StageSkipped:
+                # Only the stage that actually failed is reported.
+                continue
+            except Exception as e:
+                errors.append(f"{stage['name']}: {e}")
+                continue
+            results[stage["name"]] = {
+                "generation_id": generation.id,
+                "video_url": video_url,
+            }
+        if errors:
+            raise ValueError("Pipeline failed: " + "; ".join(errors))
+
+        last = results[stages[-1]["name"]]
+        return {
+            "ui": {"text": [last["generation_id"]]},
+            "result": (
+                last["video_url"],
+                last["generation_id"],
+                json.dumps(results),
+            ),
+        }
@@ -0,0 +1,202 @@
+import asyncio
+import contextlib
+import hashlib
+import os
+import threading
+import time
+
+import aiohttp
+import comfy.model_management
+import comfy.utils
+import requests
+from server import PromptServer
+
+CHUNK_SIZE = 1024 * 1024
+
+_scope = threading.local()
+
+
+@contextlib.contextmanager
+def interrupt_scope(event):
+    """
+    Share one interrupt between threads working for the same node.
+
+    ComfyUI's interrupt flag is cleared by the first check that sees it, so
+    only one thread would stop. Inside this scope that thread also sets
+    `event`, and every other thread in the scope stops at its next check.
+    """
+    previous = getattr(_scope, "event", None)
+    _scope.event = event
+    try:
+        yield event
+    finally:
+        _scope.event = previous
+
+
+def check_interrupted():
+    """
+    Raise ComfyUI's InterruptProcessingException if the user cancelled.
+    """
+    event = getattr(_scope, "event", None)
+    if event is not None and event.is_set():
+        raise comfy.model_management.InterruptProcessingException()
+    try:
+        comfy.model_management.throw_exception_if_processing_interrupted()
+    except comfy.model_management.InterruptProcessingException:
+        if event is not None:
+            event.set()
+        raise
+
+
+def interruptible_sleep(seconds, step=0.25):
+    deadline = time.time() + seconds
+    while True:
+        check_interrupted()
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(min(step, remaining))
+
+
+async def interruptible_async_sleep(seconds, step=0.25):
+    deadline = time.time() + seconds
+    while True:
+        check_interrupted()
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(step, remaining))
+
+
+def iter_download(url, progress=None):
+    """
+    Stream `url` in chunks, reporting bytes to `progress` and stopping as
+    soon as the prompt is interrupted. The response is always closed.
+    """
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        total = int(response.headers.get("Content-Length") or 0)
+        done = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            check_interrupted()
+            done += len(chunk)
+            if progress is not None:
+                progress.download(done, total)
+            yield chunk
+
+
+async def aiter_download(url, progress=None):
+    """
+    Async counterpart of iter_download, streaming with aiohttp.
+    """
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            total = response.content_length or 0
+            done = 0
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                check_interrupted()
+                done += len(chunk)
+                if progress is not None:
+                    progress.download(done, total)
+                yield chunk
+
+
+class DownloadWriter:
+    """
+    Writes a download to `file_name`, hashing it on the way. A partial file
+    is removed if the download fails or is interrupted.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def __enter__(self):
+        self.file = open(self.file_name, "wb")
+        return self
+
+    def write(self, chunk):
+        self.digest.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is not None and os.path.exists(self.file_name):
+            os.remove(self.file_name)
+        return False
+
+    def result(self):
+        return self.digest.hexdigest(), self.size
+
+
+def download_file(url, file_name, progress=None):
+    """
+    Download `url` to `file_name`, returning the content's SHA-256 and size.
+    """
+    with DownloadWriter(file_name) as writer:
+        for chunk in iter_download(url, progress):
+            writer.write(chunk)
+    return writer.result()
+
+
+async def async_download_file(url, file_name, progress=None):
+    """
+    Async counterpart of download_file, streaming with aiohttp.
+    """
+    with DownloadWriter(file_name) as writer:
+        async for chunk in aiter_download(url, progress):
+            writer.write(chunk)
+    return writer.result()
+
+
+def current_prompt_id():
+    return getattr(getattr(PromptServer, "instance", None), "last_prompt_id", None)
+
+
+def queued_prompts():
+    """
+    Prompts queued or running, counting the current one.
+    """
+    try:
+        return max(1, PromptServer.instance.prompt_queue.get_tasks_remaining())
+    except AttributeError:
+        return 1
+
+
+class GenerationProgress:
+    """
+    Drives the node's progress bar: the first 90% follows the generation
+    against how long the model usually takes, the rest follows the download.
+    State transitions are also sent to the frontend as `lumaai.state`.
+    """
+
+    STEPS = 1000
+
+    def __init__(self):
+        self.bar = comfy.utils.ProgressBar(self.STEPS)
+        self.state = None
+
+    def generation(self, generation_id, state, elapsed, expected=None):
+        if state != self.state:
+            self.state = state
+            print(f"Generation {generation_id} is {state}")
+            # No server instance when nodes are driven headless (e.g. soak tests).
+            server = getattr(PromptServer, "instance", None)
+            if server is not None:
+                server.send_sync(
+                    "lumaai.state", {"generation_id": generation_id, "state": state}
+                )
+        if state == "dreaming":
+            fraction = 0.1 + 0.8 * min(elapsed / (expected or 120), 0.99)
+        elif state == "completed":
+            fraction = 0.9
+        else:
+            fraction = 0.05
+        self.bar.update_absolute(int(fraction * self.STEPS))
+
+    def download(self, done, total):
+        fraction = 0.9 + 0.1 * (done / total if total else 0.5)
+        self.bar.update_absolute(int(min(fraction, 1.0) * self.STEPS))
@@ -0,0 +1,56 @@
+import io
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+# Photon and Ray generate at most 1080p, so reference pixels beyond a
+# 1920px long side only add upload and fetch time.
+MAX_REFERENCE_SIZE = 1920
+
+FORMATS = ["JPEG", "WEBP", "PNG"]
+
+
+def downscale_batch(images, max_size=MAX_REFERENCE_SIZE):
+    """
+    Downscale a ComfyUI IMAGE batch ([B, H, W, C] floats) so its longest
+    side is at most `max_size`, resizing the whole batch in one call.
+    """
+    height, width = images.shape[1], images.shape[2]
+    if not max_size or max(height, width) <= max_size:
+        return images
+    scale = max_size / max(height, width)
+    size = (max(1, round(height * scale)), max(1, round(width * scale)))
+    resized = F.interpolate(
+        images.movedim(-1, 1), size=size, mode="bilinear", antialias=True
+    )
+    return resized.movedim(1, -1)
+
+
+def encode_batch(images, format="JPEG", quality=90):
+    """
+    Encode an IMAGE batch to one file per image. Only pixels are written, so
+    no metadata from the original upload survives.
+    """
+    # Convert the whole batch to uint8 at once instead of image by image.
+    pixels = (images.clamp(0, 1) * 255.0).round().to(torch.uint8).cpu().numpy()
+    encoded = []
+    for array in pixels:
+        image = Image.fromarray(np.ascontiguousarray(array[..., :3]))
+        buffer = io.BytesIO()
+        if format == "PNG":
+            image.save(buffer, format="PNG", optimize=True)
+        elif format == "WEBP":
+            image.save(buffer, format="WEBP", quality=quality, method=4)
+        else:
+            image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def preprocess_references(images, max_size=MAX_REFERENCE_SIZE, format="JPEG", quality=90):
+    """
+    Shrink and re-encode a batch of reference images for upload.
+    """
+    return encode_batch(downscale_batch(images, max_size), format, quality)